@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+import logging
+
+from django.db.models import Count, F, Sum
+
+from .bulk import chunks, BULK_BATCH_SIZE
+
+log = logging.getLogger('vkontakte_photos')
+
+# aggregated columns of Album and counters of Photo, summed in them. Photos are counted if counter is None
+ALBUM_AGGREGATES = (
+    ('photos_count', None),
+    ('photos_likes_count', 'likes_count'),
+    ('photos_comments_count', 'comments_count'),
+)
+
+# fields of Photo, which changes affect aggregated columns of Album
+PHOTO_AGGREGATED_FIELDS = ['album_id', 'likes_count', 'comments_count']
+
+
+class AlbumAggregates(object):
+    '''
+    Deltas of aggregated columns of albums, collected from changes of photos
+    and applied by one UPDATE per album
+    '''
+    def __init__(self):
+        self.deltas = defaultdict(lambda: defaultdict(int))
+
+    def add(self, counters, sign=1):
+        '''
+        Add photo with `counters` (dict with fields PHOTO_AGGREGATED_FIELDS) to aggregates of its album,
+        or subtract it if `sign` is -1
+        '''
+        if not counters or not counters.get('album_id'):
+            return
+        deltas = self.deltas[counters['album_id']]
+        for field_name, photo_field_name in ALBUM_AGGREGATES:
+            deltas[field_name] += sign * ((counters[photo_field_name] or 0) if photo_field_name else 1)
+
+    def change(self, old_counters, counters):
+        self.add(old_counters, -1)
+        self.add(counters)
+
+    def apply(self):
+        from .models import Album
+
+        for album_id, deltas in self.deltas.items():
+            values = dict([(field_name, F(field_name) + delta) for field_name, delta in deltas.items() if delta])
+            if values:
+                Album.objects.filter(pk=album_id).update(**values)
+        log.debug('Applied deltas of aggregates of %d albums' % len(self.deltas))
+        self.deltas.clear()
+
+
+def get_aggregates_query(photos):
+    '''
+    Return values of aggregated columns for every album of queryset of photos by one GROUP BY query
+    '''
+    return photos.values('album').annotate(photos_count=Count('id'),
+                                           photos_likes_count=Sum('likes_count'),
+                                           photos_comments_count=Sum('comments_count'))
+
+
+def repair_album_aggregates(albums):
+    '''
+    Recompute aggregated columns of queryset of albums from their photos in chunks
+    and write only changed ones. Returns number of repaired albums
+    '''
+    from .models import Album, Photo
+
+    field_names = [field_name for field_name, photo_field_name in ALBUM_AGGREGATES]
+    repaired = 0
+    for batch in chunks(albums.values_list('pk', *field_names), BULK_BATCH_SIZE):
+        actual = dict([(values['album'], values) for values in
+                       get_aggregates_query(Photo.objects.filter(album__in=[row[0] for row in batch]))])
+        for row in batch:
+            values = dict([(field_name, actual.get(row[0], {}).get(field_name) or 0) for field_name in field_names])
+            if [values[field_name] for field_name in field_names] != list(row[1:]):
+                Album.objects.filter(pk=row[0]).update(**values)
+                repaired += 1
+
+    log.info('Repaired aggregates of %d albums' % repaired)
+    return repaired
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import logging
+
+log = logging.getLogger('vkontakte_photos')
+
+BULK_BATCH_SIZE = 500
+
+
+def chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class UpsertResult(object):
+    '''
+    Result of bulk_upsert(): instances splitted by the kind of statement, applied to their rows.
+    `updated` contains tuples (instance, dict of old values of changed fields)
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.created = []
+        self.updated = []
+        self.unchanged = []
+
+    def __repr__(self):
+        return '<UpsertResult %s: created %d, updated %d, unchanged %d>' % (
+            self.model.__name__, len(self.created), len(self.updated), len(self.unchanged))
+
+    @property
+    def instances(self):
+        return self.created + [instance for instance, changed in self.updated] + self.unchanged
+
+    @property
+    def counts(self):
+        return {
+            'created': len(self.created),
+            'updated': len(self.updated),
+            'unchanged': len(self.unchanged),
+        }
+
+
+def get_compared_fields(model, exclude=()):
+    return [field for field in model._meta.local_fields if not field.primary_key and field.name not in exclude]
+
+
+def bulk_upsert(model, instances, key='remote_id', exclude=('fetched',)):
+    '''
+    Save parsed instances with set-based statements: one SELECT of existing rows by `key`,
+    INSERT of new rows by bulk_create() and UPDATE of only changed columns of existing rows.
+    Fields from `exclude` are not compared, but written together with changed fields.
+    '''
+    result = UpsertResult(model)
+
+    # the last instance wins if the same object appears in response twice
+    instances_by_key = {}
+    for instance in instances:
+        instances_by_key[getattr(instance, key)] = instance
+    if not instances_by_key:
+        return result
+
+    fields = get_compared_fields(model, exclude)
+    extra_fields = [model._meta.get_field(name) for name in exclude]
+
+    existing = {}
+    for keys in chunks(instances_by_key.keys(), BULK_BATCH_SIZE):
+        for old_instance in model.objects.filter(**{'%s__in' % key: keys}):
+            existing[getattr(old_instance, key)] = old_instance
+
+    for value, instance in instances_by_key.items():
+        old_instance = existing.get(value)
+        if old_instance is None:
+            result.created += [instance]
+            continue
+
+        instance._substitute(old_instance)
+        changed = dict([(field.attname, getattr(old_instance, field.attname)) for field in fields
+                        if getattr(old_instance, field.attname) != getattr(instance, field.attname)])
+        if changed:
+            values = dict([(name, getattr(instance, name)) for name in changed.keys()])
+            values.update(dict([(field.attname, getattr(instance, field.attname)) for field in extra_fields]))
+            model.objects.filter(pk=old_instance.pk).update(**values)
+            result.updated += [(instance, changed)]
+        else:
+            result.unchanged += [instance]
+
+    for batch in chunks(result.created, BULK_BATCH_SIZE):
+        model.objects.bulk_create(batch)
+
+    # bulk_create() doesn't set primary keys of created instances
+    created_by_key = dict([(getattr(instance, key), instance) for instance in result.created])
+    for keys in chunks(created_by_key.keys(), BULK_BATCH_SIZE):
+        for value, pk in model.objects.filter(**{'%s__in' % key: keys}).values_list(key, 'pk'):
+            created_by_key[value].pk = pk
+
+    log.debug('Bulk upsert of %s objects: %s' % (model.__name__, result.counts))
+    return result
+
+
+def bulk_sync_m2m(instance, field_name, ids, remove=True):
+    '''
+    Make rows of m2m relation `field_name` of `instance` equal to the set of `ids` of related objects
+    with one SELECT of current rows, bulk INSERT of added and DELETE of removed rows.
+    If `remove` is False, rows are only added. Signal m2m_changed is not sent.
+    Returns tuple of sets of added and removed ids
+    '''
+    field = instance._meta.get_field(field_name)
+    through = field.rel.through
+    source = field.m2m_field_name() + '_id'
+    target = field.m2m_reverse_field_name() + '_id'
+
+    ids = set(ids)
+    current = set(through.objects.filter(**{source: instance.pk}).values_list(target, flat=True))
+    added = ids.difference(current)
+    removed = current.difference(ids) if remove else set()
+
+    for batch in chunks(removed, BULK_BATCH_SIZE):
+        through.objects.filter(**{source: instance.pk, '%s__in' % target: batch}).delete()
+    for batch in chunks(added, BULK_BATCH_SIZE):
+        through.objects.bulk_create([through(**{source: instance.pk, target: pk}) for pk in batch])
+
+    log.debug('Bulk sync of %s.%s of %s: added %d, removed %d' % (
+        instance.__class__.__name__, field_name, instance.pk, len(added), len(removed)))
+    return added, removed
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+import simplejson as json
+
+log = logging.getLogger('vkontakte_photos')
+
+# cache backend alias or path for responses of API
+CACHE_BACKEND = getattr(settings, 'VKONTAKTE_PHOTOS_CACHE_BACKEND', 'default')
+# seconds to keep response of every cached method, for example {'photos.getAlbums': 300, 'photos.get': 60}.
+# Responses of methods, missing here, are not cached
+CACHE_TIMEOUTS = getattr(settings, 'VKONTAKTE_PHOTOS_CACHE_TIMEOUTS', {})
+CACHE_PREFIX = 'vkontakte_photos'
+
+
+class ResponseCache(object):
+    '''
+    Cache of API responses, keyed by method and normalized parameters of call
+    '''
+    def __init__(self, timeouts=CACHE_TIMEOUTS, backend=CACHE_BACKEND):
+        self.timeouts = timeouts
+        self.backend = backend
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_cache(self.backend)
+        return self._cache
+
+    def is_cached(self, method):
+        return bool(self.timeouts.get(method))
+
+    def get_version_key(self, method):
+        return '%s:version:%s' % (CACHE_PREFIX, method)
+
+    def get_version(self, method):
+        '''
+        Return generation of cached responses of method, which is changed by invalidation of all responses of method.
+        Generations are microseconds of their start and never repeat, so expired or evicted generation can't bring
+        back responses, cached before the next invalidation
+        '''
+        key = self.get_version_key(method)
+        version = self.cache.get(key)
+        if version is None:
+            version = self.new_version(method)
+        return version
+
+    def new_version(self, method):
+        key = self.get_version_key(method)
+        version = max(int(time.time() * 1000000), (self.cache.get(key) or 0) + 1)
+        self.cache.set(key, version, self.timeouts.get(method) or 1)
+        return version
+
+    def get_key(self, method, params):
+        params = sorted([(key, unicode(value)) for key, value in params.items() if value is not None])
+        digest = hashlib.md5(json.dumps(params).encode('utf-8')).hexdigest()
+        return '%s:%s:%s:%s' % (CACHE_PREFIX, method, self.get_version(method), digest)
+
+    def get(self, method, params):
+        '''
+        Return cached response or None
+        '''
+        if not self.is_cached(method):
+            return None
+        response = self.cache.get(self.get_key(method, params))
+        if response is not None:
+            log.debug('Response of %s was taken from cache' % method)
+        return response
+
+    def set(self, method, params, response):
+        if self.is_cached(method):
+            self.cache.set(self.get_key(method, params), response, self.timeouts[method])
+
+    def invalidate(self, method, **params):
+        '''
+        Remove cached response of method for parameters or all cached responses of method if no parameters given
+        '''
+        if params:
+            self.cache.delete(self.get_key(method, params))
+        else:
+            self.new_version(method)
+
+
+# one cache for responses of all remote managers of the process
+response_cache = ResponseCache()
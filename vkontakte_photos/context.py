@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction, IntegrityError
+from vkontakte_groups.models import Group
+from vkontakte_users.models import User
+
+from .bulk import chunks, BULK_BATCH_SIZE
+
+log = logging.getLogger('vkontakte_photos')
+
+IDENTITY_MAP_SIZE = getattr(settings, 'VKONTAKTE_PHOTOS_IDENTITY_MAP_SIZE', 10000)
+
+# undocummented feature of API. if from_id == 101 -> comment by group
+FROM_ID_GROUP = 101
+
+
+class LRUCache(object):
+    '''
+    Dictionary with bounded size, which evicts least recently used keys
+    '''
+    def __init__(self, size=IDENTITY_MAP_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+        self.items[key] = value
+        return value
+
+    def set(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+
+@contextmanager
+def savepoint():
+    '''
+    Savepoint, rolled back on error without breaking enclosing transaction. On Django 1.6 it's nested atomic(),
+    because errors of queries inside atomic block mark the whole block for rollback
+    '''
+    if hasattr(transaction, 'atomic'):
+        with transaction.atomic():
+            yield
+        return
+
+    sid = transaction.savepoint()
+    try:
+        yield
+    except Exception:
+        transaction.savepoint_rollback(sid)
+        raise
+    transaction.savepoint_commit(sid)
+
+
+def create_stubs(model, remote_ids):
+    '''
+    Insert stubs of model with `remote_ids` by one statement inside savepoint.
+    If some of them were inserted concurrently by another thread or process,
+    insert only stubs, which are still missing
+    '''
+    try:
+        with savepoint():
+            model.objects.bulk_create([model(remote_id=remote_id) for remote_id in remote_ids])
+    except IntegrityError:
+        existing = model.objects.filter(remote_id__in=remote_ids).values_list('remote_id', flat=True)
+        for remote_id in set(remote_ids).difference(existing):
+            model.objects.get_or_create(remote_id=remote_id)
+
+
+def get_or_create_by_remote_ids(model, remote_ids):
+    '''
+    Return dict remote_id -> instance of model, creating missing instances in bulk
+    '''
+    remote_ids = set(remote_ids)
+    instances = {}
+    for ids in chunks(remote_ids, BULK_BATCH_SIZE):
+        for instance in model.objects.filter(remote_id__in=ids):
+            instances[instance.remote_id] = instance
+
+    missing = remote_ids.difference(instances.keys())
+    if missing:
+        for ids in chunks(missing, BULK_BATCH_SIZE):
+            create_stubs(model, ids)
+            # primary keys of stubs are known only after re-selecting them
+            for instance in model.objects.filter(remote_id__in=ids):
+                instances[instance.remote_id] = instance
+        log.debug('Created %d stubs of %s in bulk' % (len(missing), model.__name__))
+
+    return instances
+
+
+class FetchContext(object):
+    '''
+    State, shared between all instances parsed during one fetch.
+    Resolves owners (users and groups), albums and authors of comments once per fetch
+    instead of once per parsed object
+    '''
+    content_type_ids = {}
+
+    def __init__(self, album=None, photo=None, group=None, size=IDENTITY_MAP_SIZE):
+        self.photo = photo
+        # group of comments, written by group, if they are of many photos
+        self.group = group
+        self.owners = LRUCache(size)
+        self.albums = LRUCache(size)
+        if album:
+            self.albums.set(album.remote_id, album)
+
+    def prefetch(self, response_list):
+        '''
+        Resolve all owners of the page of response by a few queries
+        '''
+        owner_ids = set()
+        album_ids = set()
+        for resource in response_list:
+            if not isinstance(resource, dict):
+                continue
+            for key in ['owner_id', 'user_id', 'from_id']:
+                if resource.get(key) and not (key == 'from_id' and resource[key] == FROM_ID_GROUP):
+                    owner_ids.add(int(resource[key]))
+            if resource.get('owner_id') and resource.get('aid') and 'pid' in resource:
+                album_ids.add('%s_%s' % (int(resource['owner_id']), resource['aid']))
+        self.prefetch_owners(owner_ids)
+        self.prefetch_albums(album_ids)
+
+    def prefetch_owners(self, owner_ids):
+        owner_ids = [owner_id for owner_id in owner_ids if owner_id not in self.owners]
+        for model, ids in ((User, [i for i in owner_ids if i > 0]), (Group, [-i for i in owner_ids if i < 0])):
+            if ids:
+                sign = 1 if model == User else -1
+                for remote_id, instance in get_or_create_by_remote_ids(model, ids).items():
+                    self.owners.set(sign * remote_id, instance)
+
+    def get_owner(self, owner_id):
+        '''
+        Return User for positive owner_id and Group for negative one
+        '''
+        owner_id = int(owner_id)
+        if owner_id == 0:
+            raise ValueError("owner_id shouldn't be equal to 0")
+
+        owner = self.owners.get(owner_id)
+        if owner is None:
+            self.prefetch_owners([owner_id])
+            owner = self.owners.get(owner_id)
+        return owner
+
+    def get_author(self, from_id):
+        '''
+        Return author of comment by `from_id` value of response
+        '''
+        if from_id == FROM_ID_GROUP:
+            return self.group or self.photo.group
+        return self.get_owner(from_id)
+
+    def get_content_type_id(self, model):
+        if model not in self.content_type_ids:
+            self.content_type_ids[model] = ContentType.objects.get_for_model(model).id
+        return self.content_type_ids[model]
+
+    def set_generic_relation(self, instance, field_name, value):
+        '''
+        Assign `value` to generic foreign key `field_name` of `instance` using cached ContentType ids
+        '''
+        field = getattr(instance.__class__, field_name)
+        setattr(instance, field.ct_field + '_id', self.get_content_type_id(value.__class__))
+        setattr(instance, field.fk_field, value.pk)
+        setattr(instance, field.cache_attr, value)
+
+    def prefetch_albums(self, remote_ids):
+        from .models import Album
+
+        remote_ids = [remote_id for remote_id in remote_ids if remote_id not in self.albums]
+        for ids in chunks(remote_ids, BULK_BATCH_SIZE):
+            for album in Album.objects.filter(remote_id__in=ids):
+                self.albums.set(album.remote_id, album)
+
+    def get_album(self, remote_id):
+        '''
+        Return Album by full remote_id or None if it doesn't exist
+        '''
+        album = self.albums.get(remote_id)
+        if album is None:
+            self.prefetch_albums([remote_id])
+            album = self.albums.get(remote_id)
+        return album
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import os
+
+from django.conf import settings
+from django.utils import timezone
+import requests
+
+from .parser import get_adapter, ThreadSessions
+from .sizes import SIZES_SEPARATOR, SIZE_SEPARATOR
+from .workers import run_in_threads
+
+log = logging.getLogger('vkontakte_photos')
+
+# directory of downloaded files of photos
+DOWNLOAD_ROOT = getattr(settings, 'VKONTAKTE_PHOTOS_DOWNLOAD_ROOT',
+                        os.path.join(settings.MEDIA_ROOT, 'vkontakte_photos'))
+# number of threads and kept-alive connections to every host of images
+DOWNLOAD_POOL_SIZE = getattr(settings, 'VKONTAKTE_PHOTOS_DOWNLOAD_POOL_SIZE', 8)
+# number of hosts of images with kept-alive connections
+DOWNLOAD_HOSTS = getattr(settings, 'VKONTAKTE_PHOTOS_DOWNLOAD_HOSTS', 100)
+DOWNLOAD_TIMEOUT = getattr(settings, 'VKONTAKTE_PHOTOS_DOWNLOAD_TIMEOUT', 60)
+# number of attempts to continue interrupted download of file
+DOWNLOAD_RETRIES = getattr(settings, 'VKONTAKTE_PHOTOS_DOWNLOAD_RETRIES', 3)
+# types of downloaded sizes: src_big, src_xbig, src_xxbig
+DOWNLOAD_SIZES = getattr(settings, 'VKONTAKTE_PHOTOS_DOWNLOAD_SIZES', ('x', 'y', 'z'))
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PARTIAL_DIR = 'partial'
+
+
+# offsets of Range requests must be offsets of file, not of compressed content
+download_sessions = ThreadSessions(get_adapter(DOWNLOAD_POOL_SIZE, DOWNLOAD_HOSTS), {'Accept-Encoding': 'identity'})
+
+
+def encode_hashes(hashes):
+    '''
+    Return compact string with hashes of files by types of sizes: 'x:<sha1>;z:<sha1>'
+    '''
+    return SIZES_SEPARATOR.join([SIZE_SEPARATOR.join(item) for item in sorted(hashes.items())])
+
+
+def decode_hashes(value):
+    return dict([part.split(SIZE_SEPARATOR, 1) for part in value.split(SIZES_SEPARATOR)]) if value else {}
+
+
+def get_file_path(file_hash, root=DOWNLOAD_ROOT):
+    '''
+    Return path of file by hash of its content. Identical files of different photos share one path
+    '''
+    return os.path.join(root, file_hash[:2], file_hash[2:4], '%s.jpg' % file_hash)
+
+
+def get_file_hash(path):
+    file_hash = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+class PhotoDownloader(object):
+    '''
+    Downloads files of sizes of photos in pool of threads through shared kept-alive connections.
+    Files are stored by hash of content, interrupted downloads are continued from partial files
+    '''
+    def __init__(self, root=DOWNLOAD_ROOT, workers=DOWNLOAD_POOL_SIZE, session=None):
+        self.root = root
+        self.workers = workers
+        self._session = session
+
+    @property
+    def session(self):
+        # every thread of pool has own session, connections are shared
+        return self._session or download_sessions.get()
+
+    def get_partial_path(self, url):
+        return os.path.join(self.root, PARTIAL_DIR, '%s.part' % hashlib.md5(url.encode('utf-8')).hexdigest())
+
+    def fetch(self, url, path):
+        '''
+        Download `url` into `path`, requesting only the rest of file if `path` already contains its beginning
+        '''
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        response = self.session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        try:
+            if response.status_code == 416:
+                # partial file is already complete
+                return
+            response.raise_for_status()
+            # server may ignore Range header and return the whole file
+            with open(path, 'ab' if response.status_code == 206 else 'wb') as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        finally:
+            response.close()
+
+    def download(self, url):
+        '''
+        Download file and return hash of its content
+        '''
+        path = self.get_partial_path(url)
+        makedirs(os.path.dirname(path))
+
+        for attempt in range(DOWNLOAD_RETRIES):
+            try:
+                self.fetch(url, path)
+                break
+            except requests.HTTPError:
+                raise
+            except IOError as e:
+                # partial file is kept, the next attempt or the next run continues it
+                if attempt == DOWNLOAD_RETRIES - 1:
+                    raise
+                log.warning("Download of %s was interrupted after %d bytes: %s" % (
+                    url, os.path.getsize(path) if os.path.exists(path) else 0, e))
+
+        file_hash = get_file_hash(path)
+        file_path = get_file_path(file_hash, self.root)
+        if os.path.exists(file_path):
+            os.remove(path)
+            log.debug('File of %s is already stored as %s' % (url, file_path))
+        else:
+            makedirs(os.path.dirname(file_path))
+            os.rename(path, file_path)
+        return file_hash
+
+    def download_photo(self, photo, sizes=DOWNLOAD_SIZES):
+        '''
+        Download missing files of `sizes` of photo and save their hashes
+        '''
+        hashes = decode_hashes(photo.local_hashes)
+        for size_type in sizes:
+            size = photo.get_size(size_type=size_type)
+            if not size:
+                continue
+            if size_type in hashes and os.path.exists(get_file_path(hashes[size_type], self.root)):
+                continue
+            hashes[size_type] = self.download(size.src)
+
+        photo.local_hashes = encode_hashes(hashes)
+        photo.downloaded = timezone.now()
+        # narrow update, photo is not changed by API and aggregates are not affected
+        photo.__class__.objects.filter(pk=photo.pk).update(local_hashes=photo.local_hashes, downloaded=photo.downloaded)
+        return photo
+
+    def download_photos(self, photos, sizes=DOWNLOAD_SIZES):
+        '''
+        Download files of `sizes` of all photos of queryset in pool of threads.
+        Failed downloads don't stop others, their photos are left not downloaded for the next run.
+        Returns list of failed photos
+        '''
+        def download(photo):
+            try:
+                self.download_photo(photo, sizes)
+            except (IOError, OSError) as e:
+                log.error("Download of files of photo %s failed: %s" % (photo.remote_id, e))
+                photo.downloaded = None
+                photo.__class__.objects.filter(pk=photo.pk).update(downloaded=None)
+                return photo
+
+        photos = list(photos)
+        failed = [photo for photo in run_in_threads(download, photos, self.workers) if photo]
+        log.debug('Downloaded files of %d photos, failed %d' % (len(photos) - len(failed), len(failed)))
+        return failed
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import simplejson as json
+from vkontakte_api.api import api_call
+
+from .bulk import chunks
+from .ratelimit import api_rate_limiter
+
+log = logging.getLogger('vkontakte_photos')
+
+# maximum number of API calls inside one request of method `execute`
+EXECUTE_CALLS_LIMIT = 25
+
+
+def get_execute_code(calls):
+    '''
+    Return VKScript code, which makes all `calls` and returns list of their responses.
+    `calls` is list of tuples (method, params)
+    '''
+    return 'return [%s];' % ','.join(['API.%s(%s)' % (method, json.dumps(params)) for method, params in calls])
+
+
+def execute(calls):
+    '''
+    Make API calls, packing them by 25 into requests of method `execute`.
+    Returns list of responses in order of calls, failed calls have response False
+    '''
+    responses = []
+    for batch in chunks(calls, EXECUTE_CALLS_LIMIT):
+        api_rate_limiter.acquire()
+        response = api_call('execute', code=get_execute_code(batch))
+        if len(response) != len(batch):
+            raise ValueError("Method execute returned %d responses instead of %d" % (len(response), len(batch)))
+        responses += response
+        log.debug('Executed %d calls of %s in one request' % (len(batch), batch[0][0]))
+    return responses
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
+
+from .context import savepoint
+
+log = logging.getLogger('vkontakte_photos')
+
+# number of photos in every leaderboard
+LEADERBOARD_SIZE = getattr(settings, 'VKONTAKTE_PHOTOS_LEADERBOARD_SIZE', 50)
+# windows of leaderboards in days
+LEADERBOARD_WINDOWS = getattr(settings, 'VKONTAKTE_PHOTOS_LEADERBOARD_WINDOWS', (7, 30))
+# number of stored entries of every leaderboard, spare entries replace photos leaving window
+LEADERBOARD_CAPACITY = LEADERBOARD_SIZE * 2
+
+# fields of photo, which define leaderboards of photo
+LEADERBOARD_TARGETS = ('group_id', 'album_id')
+
+
+def get_boards(photo, now):
+    '''
+    Return keys of leaderboards, containing photo: tuples (target field, target id, window)
+    '''
+    created = photo.created
+    if timezone.is_aware(now) and timezone.is_naive(created):
+        created = timezone.make_aware(created, timezone.get_default_timezone())
+
+    boards = []
+    for field_name in LEADERBOARD_TARGETS:
+        if getattr(photo, field_name):
+            boards += [(field_name, getattr(photo, field_name), window) for window in LEADERBOARD_WINDOWS
+                       if created >= now - timedelta(days=window)]
+    return boards
+
+
+def update_leaderboards(photos):
+    '''
+    Add photos with changed counters to leaderboards of their groups and albums, if they get to the top,
+    update already added ones and trim leaderboards to LEADERBOARD_CAPACITY entries
+    '''
+    from .models import PhotoLeaderboard
+
+    now = timezone.now()
+    boards = {}
+    for photo in photos:
+        if photo.pk and photo.created:
+            for board in get_boards(photo, now):
+                boards.setdefault(board, []).append(photo)
+
+    for (field_name, target_id, window), photos in boards.items():
+        entries = PhotoLeaderboard.objects.filter(**{field_name: target_id, 'window': window})
+        # photos, leaving window
+        entries.filter(photo_created__lt=now - timedelta(days=window)).delete()
+
+        current = dict(entries.values_list('photo_id', 'actions_count'))
+        created = []
+        for photo in photos:
+            if photo.pk in current:
+                if current[photo.pk] != photo.actions_count:
+                    entries.filter(photo_id=photo.pk).update(actions_count=photo.actions_count)
+                    current[photo.pk] = photo.actions_count
+            elif len(current) < LEADERBOARD_CAPACITY or photo.actions_count > min(current.values()):
+                created += [PhotoLeaderboard(photo_id=photo.pk, actions_count=photo.actions_count,
+                                             photo_created=photo.created, window=window, **{field_name: target_id})]
+                current[photo.pk] = photo.actions_count
+        try:
+            with savepoint():
+                PhotoLeaderboard.objects.bulk_create(created)
+        except IntegrityError:
+            # some photos were added concurrently by another thread or process, their entries are updated
+            for entry in created:
+                try:
+                    with savepoint():
+                        entry.save(force_insert=True)
+                except IntegrityError:
+                    entries.filter(photo_id=entry.photo_id).update(actions_count=entry.actions_count)
+
+        if len(current) > LEADERBOARD_CAPACITY:
+            trimmed = sorted(current.items(), key=lambda item: item[1], reverse=True)[LEADERBOARD_CAPACITY:]
+            entries.filter(photo_id__in=[photo_id for photo_id, actions_count in trimmed]).delete()
+
+
+def rebuild_leaderboards(photos):
+    '''
+    Rebuild leaderboards of all groups and albums of queryset of photos from scratch
+    '''
+    from .models import PhotoLeaderboard
+
+    now = timezone.now()
+    rebuilt = 0
+    for field_name in LEADERBOARD_TARGETS:
+        target_ids = photos.exclude(**{field_name: None}).order_by().values_list(field_name, flat=True).distinct()
+        for target_id in target_ids:
+            for window in LEADERBOARD_WINDOWS:
+                PhotoLeaderboard.objects.filter(**{field_name: target_id, 'window': window}).delete()
+                top = photos.model.objects.filter(**{field_name: target_id, 'created__gte': now - timedelta(days=window)}) \
+                    .order_by('-actions_count').values_list('pk', 'actions_count', 'created')[:LEADERBOARD_CAPACITY]
+                PhotoLeaderboard.objects.bulk_create([
+                    PhotoLeaderboard(photo_id=photo_id, actions_count=actions_count, photo_created=created,
+                                     window=window, **{field_name: target_id})
+                    for photo_id, actions_count, created in top])
+                rebuilt += 1
+
+    log.info('Rebuilt %d leaderboards of photos' % rebuilt)
+    return rebuilt
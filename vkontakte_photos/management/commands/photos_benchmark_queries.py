@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from optparse import make_option
+import random
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from vkontakte_api.decorators import atomic
+from vkontakte_groups.models import Group
+
+from vkontakte_photos.aggregates import repair_album_aggregates
+from vkontakte_photos.bulk import chunks, BULK_BATCH_SIZE
+from vkontakte_photos.leaderboards import rebuild_leaderboards
+from vkontakte_photos.models import Album, Photo, Comment, PhotoLeaderboard
+
+# remote id of fake group, owner of all seeded objects
+BENCHMARK_GROUP_ID = 999999999
+
+# composite indexes of migration 0023_timeline_indexes
+TIMELINE_INDEXES = (
+    (Photo, ['album_id', 'created']),
+    (Photo, ['group_id', 'created']),
+    (Photo, ['owner_id', 'created']),
+    (Album, ['group_id', 'updated']),
+    (Album, ['owner_id', 'updated']),
+    (Comment, ['photo_id', 'date']),
+)
+
+
+class Command(BaseCommand):
+    help = 'Seed synthetic albums, photos and comments and measure timings of timeline and top photos queries'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--albums', type='int', default=100, help='Number of seeded albums'),
+        make_option('--photos', type='int', default=1000, help='Number of seeded photos in every album'),
+        make_option('--comments', type='int', default=100000, help='Number of seeded comments'),
+        make_option('--repeat', type='int', default=20, help='Number of runs of every query'),
+        make_option('--without-indexes', action='store_true', default=False,
+                    help='Measure again with dropped composite indexes and print both timings side by side'),
+        make_option('--explain', action='store_true', default=False, help='Print query plans'),
+        make_option('--keep', action='store_true', default=False, help="Don't delete seeded objects"),
+    )
+
+    def handle(self, **options):
+        self.options = options
+        group = self.seed()
+        try:
+            timings = self.measure(group)
+            if options['without_indexes']:
+                self.drop_indexes()
+                try:
+                    timings_without_indexes = self.measure(group)
+                finally:
+                    self.create_indexes()
+                self.compare(timings, timings_without_indexes)
+        finally:
+            if not options['keep']:
+                self.clean(group)
+
+    @atomic
+    def seed(self):
+        group = Group.objects.get_or_create(remote_id=BENCHMARK_GROUP_ID)[0]
+        prefix = -BENCHMARK_GROUP_ID
+        now = timezone.now()
+
+        albums = [Album(remote_id='%s_%s' % (prefix, i), group=group, thumb_id=0, size=self.options['photos'],
+                        created=now - timedelta(days=i), updated=now - timedelta(hours=i))
+                  for i in range(self.options['albums'])]
+        for batch in chunks(albums, BULK_BATCH_SIZE):
+            Album.objects.bulk_create(batch)
+        album_ids = list(Album.objects.filter(group=group).values_list('pk', flat=True))
+
+        photos = (Photo(remote_id='%s_%s' % (prefix, i), album_id=album_ids[i % len(album_ids)], group=group,
+                        created=now - timedelta(minutes=i), actions_count=random.randrange(10000))
+                  for i in range(self.options['albums'] * self.options['photos']))
+        for batch in chunks(photos, BULK_BATCH_SIZE):
+            Photo.objects.bulk_create(batch)
+        photo_ids = list(Photo.objects.filter(group=group).values_list('pk', flat=True))
+
+        content_type = ContentType.objects.get_for_model(Group)
+        comments = (Comment(remote_id='%s_%s' % (prefix, i), photo_id=random.choice(photo_ids),
+                            author_content_type=content_type, author_id=group.pk, date=now - timedelta(seconds=i))
+                    for i in range(self.options['comments']))
+        for batch in chunks(comments, BULK_BATCH_SIZE):
+            Comment.objects.bulk_create(batch)
+
+        # photos, inserted by bulk_create(), are subtracted from aggregates of albums while cleaning
+        repair_album_aggregates(Album.objects.filter(group=group))
+        rebuild_leaderboards(Photo.objects.filter(group=group))
+
+        self.stdout.write('Seeded %d albums, %d photos, %d comments\n' % (
+            len(album_ids), len(photo_ids), self.options['comments']))
+        return group
+
+    def get_queries(self, group):
+        album_ids = list(Album.objects.filter(group=group).values_list('pk', flat=True))
+        photo_ids = list(Photo.objects.filter(group=group).values_list('pk', flat=True)[:1000])
+        since = timezone.now() - timedelta(days=7)
+        return (
+            ('photos of album by created',
+             lambda: Photo.objects.filter(album_id=random.choice(album_ids)).order_by('-created')[:100]),
+            ('photos of group since date',
+             lambda: Photo.objects.filter(group=group, created__gte=since).order_by('-created')[:100]),
+            ('comments of photo by date',
+             lambda: Comment.objects.filter(photo_id=random.choice(photo_ids)).order_by('date')[:100]),
+            ('albums of group by updated',
+             lambda: Album.objects.filter(group=group).order_by('-updated')[:100]),
+            ('top photos of group, naive',
+             lambda: Photo.objects.filter(group=group, created__gte=since).order_by('-actions_count')[:50]),
+            ('top photos of group, leaderboard',
+             lambda: PhotoLeaderboard.objects.filter(group=group, window=7, photo_created__gte=since)
+                                             .select_related('photo').order_by('-actions_count')[:50]),
+        )
+
+    def measure(self, group):
+        '''
+        Run every query and print its timings. Returns list of tuples (name of query, median in ms)
+        '''
+        medians = []
+        for name, get_queryset in self.get_queries(group):
+            timings = []
+            for i in range(self.options['repeat']):
+                queryset = get_queryset()
+                started = time.time()
+                list(queryset)
+                timings += [time.time() - started]
+
+            timings.sort()
+            self.stdout.write('%-30s avg %8.2f ms, median %8.2f ms, max %8.2f ms\n' % (
+                name, 1000 * sum(timings) / len(timings), 1000 * timings[len(timings) / 2], 1000 * timings[-1]))
+            if self.options['explain']:
+                self.stdout.write(self.explain(get_queryset()) + '\n')
+            medians += [(name, 1000 * timings[len(timings) / 2])]
+        return medians
+
+    def compare(self, timings, timings_without_indexes):
+        self.stdout.write('%-30s %14s %14s\n' % ('median', 'with indexes', 'without them'))
+        for (name, median), (name, median_without_indexes) in zip(timings, timings_without_indexes):
+            self.stdout.write('%-30s %11.2f ms %11.2f ms\n' % (name, median, median_without_indexes))
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        explain = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        cursor = connection.cursor()
+        cursor.execute(explain + sql, params)
+        return '\n'.join([' '.join([unicode(value) for value in row]) for row in cursor.fetchall()])
+
+    def drop_indexes(self):
+        from south.db import db
+        for model, columns in TIMELINE_INDEXES:
+            db.delete_index(model._meta.db_table, columns)
+
+    def create_indexes(self):
+        from south.db import db
+        for model, columns in TIMELINE_INDEXES:
+            db.create_index(model._meta.db_table, columns)
+
+    @atomic
+    def clean(self, group):
+        PhotoLeaderboard.objects.filter(photo__group=group).delete()
+        Comment.objects.filter(photo__group=group).delete()
+        Photo.objects.filter(group=group).delete()
+        Album.objects.filter(group=group).delete()
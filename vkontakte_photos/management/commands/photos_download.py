@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from vkontakte_photos.bulk import BULK_BATCH_SIZE
+from vkontakte_photos.download import PhotoDownloader, DOWNLOAD_POOL_SIZE, DOWNLOAD_SIZES
+from vkontakte_photos.models import Photo
+
+
+class Command(BaseCommand):
+    help = 'Download files of sizes of photos, storing identical files once'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--group', type='int', default=None, help='Remote ID of group, which photos should be downloaded'),
+        make_option('--album', default=None, help='Remote ID of album, which photos should be downloaded'),
+        make_option('--sizes', default=','.join(DOWNLOAD_SIZES), help='Comma-separated types of sizes, "x,y,z" by default'),
+        make_option('--workers', type='int', default=DOWNLOAD_POOL_SIZE, help='Number of concurrent downloads'),
+        make_option('--all', action='store_true', default=False, help='Check already downloaded photos for missing files'),
+    )
+
+    def handle(self, **options):
+        photos = Photo.objects.all()
+        if options['group']:
+            photos = photos.filter(group__remote_id=options['group'])
+        if options['album']:
+            photos = photos.filter(album__remote_id=options['album'])
+        if not options['all']:
+            photos = photos.filter(downloaded__isnull=True)
+
+        downloader = PhotoDownloader(workers=options['workers'])
+        sizes = [size_type.strip() for size_type in options['sizes'].split(',') if size_type.strip()]
+
+        downloaded = 0
+        failed = 0
+        last_pk = 0
+        while True:
+            batch = list(photos.filter(pk__gt=last_pk).order_by('pk')[:BULK_BATCH_SIZE])
+            if not batch:
+                break
+            batch_failed = len(downloader.download_photos(batch, sizes))
+            downloaded += len(batch) - batch_failed
+            failed += batch_failed
+            last_pk = batch[-1].pk
+
+        self.stdout.write('Downloaded files of %d photos, failed %d\n' % (downloaded, failed))
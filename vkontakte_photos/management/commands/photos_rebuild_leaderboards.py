@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from vkontakte_photos.leaderboards import rebuild_leaderboards
+from vkontakte_photos.models import Photo
+
+
+class Command(BaseCommand):
+    help = 'Rebuild leaderboards of top photos of groups and albums'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--group', type='int', default=None, help='Remote ID of group, which leaderboards should be rebuilt'),
+    )
+
+    def handle(self, **options):
+        photos = Photo.objects.all()
+        if options['group']:
+            photos = photos.filter(group__remote_id=options['group'])
+
+        rebuilt = rebuild_leaderboards(photos)
+        self.stdout.write('Rebuilt %d leaderboards\n' % rebuilt)
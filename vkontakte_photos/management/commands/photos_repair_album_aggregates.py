@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from vkontakte_photos.aggregates import repair_album_aggregates
+from vkontakte_photos.models import Album
+
+
+class Command(BaseCommand):
+    help = 'Recompute aggregates of photos of albums: number of photos, likes and comments'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--group', type='int', default=None, help='Remote ID of group, which albums should be repaired'),
+        make_option('--user', type='int', default=None, help='Remote ID of user, which albums should be repaired'),
+    )
+
+    def handle(self, **options):
+        albums = Album.objects.all()
+        if options['group']:
+            albums = albums.filter(group__remote_id=options['group'])
+        if options['user']:
+            albums = albums.filter(owner__remote_id=options['user'])
+
+        repaired = repair_album_aggregates(albums)
+        self.stdout.write('Repaired aggregates of %d albums\n' % repaired)
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
 import logging
 from parser import VkontaktePhotosParser
-import re
 
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from vkontakte_api.decorators import fetch_all, atomic
@@ -13,8 +15,47 @@ from vkontakte_api.models import VkontakteTimelineManager, VkontakteModel, Vkont
 from vkontakte_groups.models import Group
 from vkontakte_users.models import User
 
+from .aggregates import AlbumAggregates, ALBUM_AGGREGATES, PHOTO_AGGREGATED_FIELDS
+from .bulk import bulk_upsert, bulk_sync_m2m
+from .cache import response_cache
+from .context import FetchContext
+from .download import decode_hashes, get_file_path, PhotoDownloader, DOWNLOAD_SIZES
+from .execute import execute
+from .leaderboards import update_leaderboards, LEADERBOARD_SIZE, LEADERBOARD_WINDOWS
+from .ratelimit import api_rate_limiter
+from .search import SearchManager
+from .signals import vkontakte_photos_bulk_upserted
+from .singleflight import get_flight_key, single_flight
+from .sizes import parse_sizes, encode_sizes, decode_sizes
+from .workers import run_in_threads, submit
+
 log = logging.getLogger('vkontakte_photos')
 
+# number of photos in one page of photos.get
+PHOTOS_PAGE_SIZE = 1000
+
+# number of comments in one page of photos.getComments
+COMMENTS_PAGE_SIZE = 100
+
+# number of photos, fetched again before the stored offset while syncing album
+SYNC_OFFSET_OVERLAP = 50
+
+ALBUM_SYNC_FIELDS = ['photos_synced_created', 'photos_synced_offset', 'photos_synced_updated', 'photos_synced_size']
+
+# fields of Album, which are not a part of API response and should be kept while updating album
+ALBUM_AGGREGATED_FIELDS = [field_name for field_name, photo_field_name in ALBUM_AGGREGATES]
+ALBUM_LOCAL_FIELDS = ALBUM_SYNC_FIELDS + ALBUM_AGGREGATED_FIELDS
+
+# maximum number of users, returned by likes.getList
+LIKES_COUNT_LIMIT = 1000
+
+# number of photos in one request of photos.getById
+PHOTOS_BY_ID_LIMIT = 100
+
+PHOTO_COUNTERS_FIELDS = ['likes_count', 'comments_count', 'tags_count', 'actions_count']
+# fields of photo, which are not a part of API response
+PHOTO_LOCAL_FIELDS = ['local_hashes', 'downloaded']
+
 ALBUM_PRIVACY_CHOCIES = (
     (0, u'Все пользователи'),
     (1, u'Только друзья'),
@@ -23,7 +64,115 @@ ALBUM_PRIVACY_CHOCIES = (
 )
 
 
-class AlbumRemoteManager(VkontakteTimelineManager):
+class PhotosTimelineManager(VkontakteTimelineManager):
+
+    def api_call(self, method='get', methods_namespace=None, **kwargs):
+        '''
+        Make API call through the shared rate limiter. Responses of methods,
+        configured in VKONTAKTE_PHOTOS_CACHE_TIMEOUTS, are taken from cache
+        '''
+        method_name = self.get_method_name(method, methods_namespace)
+        response = response_cache.get(method_name, kwargs)
+        if response is not None:
+            return response
+
+        api_rate_limiter.acquire()
+        response = super(PhotosTimelineManager, self).api_call(method, methods_namespace=methods_namespace, **kwargs)
+        response_cache.set(method_name, kwargs, response)
+        return response
+
+    def get_method_name(self, method='get', methods_namespace=None):
+        '''
+        Return full name of API method, for example photos.getAlbums
+        '''
+        method = self.methods.get(method, method)
+        if isinstance(method, tuple):
+            method = method[0]
+        return '%s.%s' % (methods_namespace or self.methods_namespace or self.model.methods_namespace, method)
+
+    def invalidate_cache(self, method='get', methods_namespace=None, **kwargs):
+        '''
+        Remove cached response of call with parameters `kwargs` or all cached responses of method
+        '''
+        response_cache.invalidate(self.get_method_name(method, methods_namespace), **kwargs)
+
+    def get(self, *args, **kwargs):
+        '''
+        Share one FetchContext between all instances, parsed from the response
+        '''
+        extra_fields = kwargs.setdefault('extra_fields', {})
+        extra_fields.setdefault('_fetch_context', FetchContext())
+        return super(PhotosTimelineManager, self).get(*args, **kwargs)
+
+    def parse_response_list(self, response_list, extra_fields=None):
+        context = (extra_fields or {}).get('_fetch_context')
+        if context:
+            context.prefetch(response_list)
+        return super(PhotosTimelineManager, self).parse_response_list(response_list, extra_fields)
+
+    def fetch_once(self, *args, **kwargs):
+        '''
+        Version of fetch(), which is called once for all concurrent callers with the same arguments
+        in this and other processes. Callers wait for the in-flight fetch and get its result.
+        Should be called outside of transaction
+        '''
+        key = get_flight_key(self.model, 'fetch', args, kwargs)
+        return single_flight.do(key, lambda: self.fetch(*args, **kwargs), self.model)
+
+    def afetch(self, *args, **kwargs):
+        '''
+        Non-blocking version of fetch(). Runs fetch() in the shared pool of workers
+        and returns AsyncResult, method get() of it returns result of fetch()
+        '''
+        return submit(self.fetch, *args, **kwargs)
+
+    def filter_timeline(self, instances, after=None, before=None):
+        '''
+        Filter parsed instances with respect to parameters `after` and `before` the same way as fetch() does
+        '''
+        if self.timeline_force_ordering:
+            instances.sort(key=self.get_timeline_date, reverse=True)
+
+        result = []
+        for instance in instances:
+            timeline_date = self.get_timeline_date(instance)
+            if timeline_date and isinstance(timeline_date, datetime):
+                if after and after > timeline_date:
+                    break
+                if before and before < timeline_date:
+                    continue
+            result += [instance]
+        return result
+
+    def fetch_bulk(self, *args, **kwargs):
+        '''
+        Retrieve objects and save them to local DB with a few set-based statements per page
+        instead of saving each instance
+        '''
+        after = kwargs.pop('after', None)
+        before = kwargs.pop('before', None)
+
+        result = self.get(*args, **kwargs)
+        if not isinstance(result, list):
+            result = [result]
+
+        upserted = self.save_bulk(self.filter_timeline(result, after, before))
+        return self.model.objects.filter(pk__in=[instance.pk for instance in upserted.instances])
+
+    def save_bulk(self, instances):
+        '''
+        Save parsed instances by bulk_upsert(). Counters of created, updated and unchanged rows
+        are logged and sent with signal `vkontakte_photos_bulk_upserted`
+        '''
+        upserted = bulk_upsert(self.model, instances, key=self.remote_pk[0])
+
+        log.info('Bulk fetch of %s: %s' % (self.model.__name__, upserted.counts))
+        vkontakte_photos_bulk_upserted.send(sender=self.model, result=upserted)
+
+        return upserted
+
+
+class AlbumRemoteManager(PhotosTimelineManager):
 
     timeline_force_ordering = True
 
@@ -65,14 +214,63 @@ class AlbumRemoteManager(VkontakteTimelineManager):
 
         return super(AlbumRemoteManager, self).fetch(**kwargs)
 
+    def sync_photos(self, user=None, group=None, full=False, **kwargs):
+        '''
+        Fetch albums of user or group and sync photos of albums, changed after the previous sync.
+        Albums with the same `size` and `updated` are skipped, unless `full` is True.
+        Returns dict with numbers of synced and skipped albums
+        '''
+        stats = {'synced': 0, 'skipped': 0}
+        for album in self.fetch(user=user, group=group):
+            if not full and not album.photos_changed:
+                stats['skipped'] += 1
+                continue
+            album.sync_photos(full=full, **kwargs)
+            stats['synced'] += 1
 
-class PhotoRemoteManager(VkontakteTimelineManager):
+        log.info('Sync of photos of %s: %s' % (group or user, stats))
+        return stats
+
+
+class PhotoRemoteManager(PhotosTimelineManager):
 
     timeline_cut_fieldname = 'created'
     timeline_force_ordering = True
 
+    def save_bulk(self, instances):
+        '''
+        Save photos in bulk and apply changes of their counters to aggregates of albums
+        '''
+        upserted = super(PhotoRemoteManager, self).save_bulk(instances)
+
+        aggregates = AlbumAggregates()
+        for photo in upserted.created:
+            aggregates.add(photo.get_counters())
+        for photo, changed in upserted.updated:
+            old_counters = photo.get_counters()
+            old_counters.update([(name, value) for name, value in changed.items() if name in old_counters])
+            aggregates.change(old_counters, photo.get_counters())
+        aggregates.apply()
+
+        update_leaderboards(upserted.created + [photo for photo, changed in upserted.updated
+                                                if 'actions_count' in changed])
+
+        for photo in upserted.instances:
+            photo._counters = photo.get_counters()
+        return upserted
+
     @atomic
-    def fetch(self, album, ids=None, limit=None, extended=False, offset=0, photo_sizes=False, before=None, rev=0, after=None, **kwargs):
+    def get_or_create_from_instance(self, instance):
+        '''
+        Save photo, fetched without bulk, and apply changes of its counters to aggregates of album.
+        Created photo is already added to them by save()
+        '''
+        instance = super(PhotoRemoteManager, self).get_or_create_from_instance(instance)
+        instance.update_aggregates(getattr(instance, '_counters', None))
+        return instance
+
+    @atomic
+    def fetch(self, album, ids=None, limit=None, extended=False, offset=0, photo_sizes=False, before=None, rev=0, after=None, bulk=False, **kwargs):
         if ids and not isinstance(ids, (tuple, list)):
             raise ValueError("Attribute 'ids' should be tuple or list")
         if before and not after:
@@ -83,14 +281,37 @@ class PhotoRemoteManager(VkontakteTimelineManager):
         if rev == 1 and (after or before):
             raise ValueError("Attribute `rev` should be equal to 0 with defined `after` attribute")
 
-        kwargs = {
+        context = kwargs.get('context')
+        kwargs = self.get_fetch_kwargs(album, ids=ids, limit=limit, extended=extended, offset=offset,
+                                       photo_sizes=photo_sizes, rev=rev)
+
+        # special parameters
+        kwargs['after'] = after
+        kwargs['before'] = before
+
+        # album of all photos is known already
+        kwargs['extra_fields'] = {'_fetch_context': context or FetchContext(album=album)}
+
+        if bulk:
+            return self.fetch_bulk(**kwargs)
+
+        photos = super(PhotoRemoteManager, self).fetch(**kwargs)
+        # leaderboards are updated once for all photos of response
+        update_leaderboards(photos)
+        return photos
+
+    def get_fetch_kwargs(self, album, ids=None, limit=None, extended=False, offset=0, photo_sizes=False, rev=0, **kwargs):
+        '''
+        Return parameters of API method photos.get
+        '''
+        kwargs.update({
             'album_id': album.remote_id.split('_')[1],
             'extended': int(extended),
             'offset': int(offset),
             # photo_sizes
             # 1 - позволяет получать все размеры фотографий.
             'photo_sizes': int(photo_sizes),
-        }
+        })
         if album.owner:
             kwargs.update({'uid': album.owner.remote_id})
         elif album.group:
@@ -102,25 +323,258 @@ class PhotoRemoteManager(VkontakteTimelineManager):
 
         kwargs['rev'] = int(rev)
 
-        # special parameters
-        kwargs['after'] = after
-        kwargs['before'] = before
-
         # TODO: добавить поля
         # feed
         # Unixtime, который может быть получен методом newsfeed.get в поле date, для получения всех фотографий загруженных пользователем в определённый день либо на которых пользователь был отмечен. Также нужно указать параметр uid пользователя, с которым произошло событие.
         # feed_type
         # Тип новости получаемый в поле type метода newsfeed.get, для получения только загруженных пользователем фотографий, либо только фотографий, на которых он был отмечен. Может принимать значения photo, photo_tag.
 
-        return super(PhotoRemoteManager, self).fetch(**kwargs)
+        return kwargs
 
+    def iter_fetch(self, album, count=PHOTOS_PAGE_SIZE, offset=0, after=None, before=None, bulk=True, **kwargs):
+        '''
+        Generator, fetching photos of album page by page. Yields offset of the next page and list of saved photos.
+        Offset is advanced by number of items in response, not by number of saved photos.
+        Photos in antichronological order (rev=1) are fetched till the first page with photos older than `after`.
+        Every page is saved in own transaction, only one page is kept in memory
+        '''
+        context = FetchContext(album=album)
+        while True:
+            params = self.get_fetch_kwargs(album, limit=count, offset=offset, **kwargs)
+            response = self.api_call(**params)
+            instances = self.parse_response(response, {'fetched': timezone.now(), '_fetch_context': context})
+
+            with atomic():
+                photos = self.filter_timeline(list(instances), after, before)
+                if bulk:
+                    photos = self.save_bulk(photos).instances
+                else:
+                    photos = [self.get_or_create_from_instance(instance) for instance in photos]
+
+            log.debug('Fetched page of %d photos of album %s, offset %d' % (len(response), album.remote_id, offset))
+            offset += len(response)
+            yield offset, photos
+
+            if len(response) < count:
+                break
+            if after and kwargs.get('rev') and any([self.get_timeline_date(instance) < after
+                                                    for instance in instances]):
+                break
+
+    def iter_sync(self, album, full=False, **kwargs):
+        '''
+        Generator, syncing photos of album page by page from the stored cursor of album.
+        Cursor is saved after each page
+        '''
+        offset, after = album.get_photos_cursor(full)
+        for offset, photos in self.iter_fetch(album, offset=offset, after=after, **kwargs):
+            album.save_photos_cursor(offset)
+            yield offset, photos
 
-class CommentRemoteManager(VkontakteTimelineManager):
+    @atomic
+    def fetch_likes_photos(self, photos):
+        '''
+        Fetch users liked every photo, packing up to 25 calls of likes.getList into one API request
+        '''
+        photos = list(photos)
+        calls = [('likes.getList', {
+            'type': 'photo',
+            'owner_id': photo.remote_owner_id,
+            'item_id': photo.remote_id_short,
+            'count': LIKES_COUNT_LIMIT,
+        }) for photo in photos]
+
+        context = FetchContext()
+        for photo, response in zip(photos, execute(calls)):
+            if not response:
+                log.warning('Impossible to fetch likes of photo %s' % photo.remote_id)
+                continue
+            photo.update_like_users(response['users'], count=response['count'], context=context)
+
+        return photos
+
+    def fetch_like_user_ids(self, photo):
+        '''
+        Fetch remote ids of all users liked the photo by pages of likes.getList.
+        Returns list of ids and total number of likes
+        '''
+        ids = []
+        while True:
+            response = self.api_call('getList', methods_namespace='likes', type='photo',
+                                     owner_id=photo.remote_owner_id, item_id=photo.remote_id_short,
+                                     offset=len(ids), count=LIKES_COUNT_LIMIT)
+            ids += response['users']
+            if not response['users'] or len(ids) >= response['count']:
+                break
+        return ids, response['count']
+
+    def refresh_counters(self, photos):
+        '''
+        Update counters of likes, comments and tags of photos by requests of photos.getById,
+        each for PHOTOS_BY_ID_LIMIT photos. Photos are read by ranges of pk, one batch at a time.
+        Only changed counters are written, photos with the same new values by one UPDATE.
+        Returns number of updated photos
+        '''
+        updated = 0
+        last_pk = 0
+        photos = photos.only('id', 'remote_id', 'album', 'group', 'created', *PHOTO_COUNTERS_FIELDS).order_by('pk')
+        while True:
+            batch = list(photos.filter(pk__gt=last_pk)[:PHOTOS_BY_ID_LIMIT])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            changed = []
+            updates = {}
+            aggregates = AlbumAggregates()
+            photos_by_remote_id = dict([(photo.remote_id, photo) for photo in batch])
+            response = self.api_call('get_by_id', photos=','.join(photos_by_remote_id.keys()), extended=1)
+            for resource in response:
+                photo = photos_by_remote_id.get('%s_%s' % (resource['owner_id'], resource['pid']))
+                if photo is None:
+                    continue
+                counters = {}
+                for field_name in ['likes', 'comments', 'tags']:
+                    if 'count' in resource.get(field_name, {}):
+                        counters['%s_count' % field_name] = resource[field_name]['count']
+                counters['actions_count'] = counters.get('likes_count', photo.likes_count) \
+                    + counters.get('comments_count', photo.comments_count)
+
+                counters = dict([(field_name, value) for field_name, value in counters.items()
+                                 if getattr(photo, field_name) != value])
+                if counters:
+                    updates.setdefault(tuple(sorted(counters.items())), []).append(photo.pk)
+                    old_counters = photo.get_counters()
+                    for field_name, value in counters.items():
+                        setattr(photo, field_name, value)
+                    aggregates.change(old_counters, photo.get_counters())
+                    changed += [photo]
+
+            with atomic():
+                for counters, pks in updates.items():
+                    self.model.objects.filter(pk__in=pks).update(**dict(counters))
+                aggregates.apply()
+                update_leaderboards(changed)
+            updated += len(changed)
+
+        log.info('Refreshed counters of %d photos' % updated)
+        return updated
+
+    def fetch_albums(self, albums, workers=4, **kwargs):
+        '''
+        Fetch photos of many albums concurrently in a pool of `workers` threads.
+        Every album is fetched in own transaction and DB connection of worker thread,
+        so albums should be committed to DB before calling this method.
+        API calls of all workers are throttled by shared rate limiter.
+        Returns queryset of photos of all albums
+        '''
+        albums = list(albums)
+        run_in_threads(lambda album: self.fetch(album=album, **kwargs), albums, workers)
+        return self.model.objects.filter(album__in=albums)
+
+
+class CommentRemoteManager(PhotosTimelineManager):
 
     @atomic
-    @fetch_all(default_count=100)
-    def fetch_album(self, album, offset=0, count=100, sort='asc', need_likes=True, before=None, after=None, **kwargs):
-        raise NotImplementedError
+    def fetch_album(self, album, offset=0, count=COMMENTS_PAGE_SIZE, need_likes=True, all=False):
+        '''
+        Fetch comments of all photos of album by method photos.getAllComments instead of one request per photo.
+        If `all` is True, fetch all pages starting from `offset`
+        '''
+        ids = []
+        for offset, comments in self.iter_fetch_album(album, offset=offset, count=count, need_likes=need_likes):
+            ids += [comment.pk for comment in comments]
+            if not all:
+                break
+        return self.model.objects.filter(pk__in=ids)
+
+    def iter_fetch_album(self, album, offset=0, count=COMMENTS_PAGE_SIZE, need_likes=True):
+        '''
+        Generator, fetching comments of album page by page. Comments are routed to photos by `pid`
+        of response through the map of photos of album and saved in bulk, each page in own transaction.
+        Yields offset of the next page and list of saved comments
+        '''
+        if count > 100:
+            raise ValueError("Attribute 'count' can not be more than 100")
+
+        photos = dict([(photo.remote_id, photo) for photo in album.photos.only('id', 'remote_id')])
+        context = FetchContext(group=album.group)
+        while True:
+            response = self.api_call('get_album', owner_id=album.remote_owner_id, album_id=album.remote_id_short,
+                                     need_likes=int(need_likes), offset=int(offset), count=int(count))
+            if isinstance(response, dict):
+                response = response.get('items', [])
+            response = [resource for resource in response if isinstance(resource, dict)]
+
+            with atomic():
+                # photos, added to album after the last fetch of photos
+                missing = set([resource['pid'] for resource in response]).difference(
+                    [int(remote_id.split('_')[1]) for remote_id in photos.keys()])
+                if missing:
+                    for photo in Photo.remote.fetch(album=album, ids=list(missing)):
+                        photos[photo.remote_id] = photo
+
+                context.prefetch(response)
+                instances = []
+                for resource in response:
+                    photo = photos.get('%s_%s' % (album.remote_owner_id, resource.pop('pid')))
+                    if photo is None:
+                        log.warning('Impossible to save comment %s for unexisted photo of album %s' % (
+                            resource.get('cid'), album.remote_id))
+                        continue
+                    instances += [self.parse_response_dict(resource, {
+                        'photo': photo,
+                        'fetched': timezone.now(),
+                        '_fetch_context': context,
+                    })]
+                comments = self.save_bulk(instances).instances
+
+            log.debug('Fetched page of %d comments of album %s, offset %d' % (len(response), album.remote_id, offset))
+            offset += len(response)
+            yield offset, comments
+
+            if len(response) < count:
+                break
+
+    @atomic
+    def fetch_photos(self, photos, count=100, sort='asc', need_likes=True):
+        '''
+        Fetch the first `count` comments of every photo,
+        packing up to 25 calls of photos.getComments into one API request
+        '''
+        if count > 100:
+            raise ValueError("Attribute 'count' can not be more than 100")
+        if sort not in ['asc', 'desc']:
+            raise ValueError("Attribute 'sort' should be equal to 'asc' or 'desc'")
+
+        photos = list(photos)
+        calls = [('photos.getComments', {
+            'owner_id': photo.remote_owner_id,
+            'photo_id': photo.remote_id_short,
+            'count': int(count),
+            'sort': sort,
+            'need_likes': int(need_likes),
+        }) for photo in photos]
+
+        ids = []
+        for photo, response in zip(photos, execute(calls)):
+            if response is False:
+                log.warning('Impossible to fetch comments of photo %s' % photo.remote_id)
+                continue
+            if isinstance(response, dict):
+                response = response.get('items', [])
+
+            extra_fields = {'photo_id': photo.id, 'fetched': timezone.now(), '_fetch_context': FetchContext(photo=photo)}
+            for instance in self.parse_response(response, extra_fields):
+                ids += [self.get_or_create_from_instance(instance).pk]
+
+        return self.model.objects.filter(pk__in=ids)
+
+    def afetch_photo(self, *args, **kwargs):
+        '''
+        Non-blocking version of fetch_photo(), returns AsyncResult
+        '''
+        return submit(self.fetch_photo, *args, **kwargs)
 
     @atomic
     @fetch_all(default_count=100)
@@ -168,7 +622,7 @@ class CommentRemoteManager(VkontakteTimelineManager):
         kwargs['after'] = after
         kwargs['before'] = before
 
-        kwargs['extra_fields'] = {'photo_id': photo.id}
+        kwargs['extra_fields'] = {'photo_id': photo.id, '_fetch_context': FetchContext(photo=photo)}
 #        try:
         return super(CommentRemoteManager, self).fetch(**kwargs)
 #         except VkontakteError, e:
@@ -192,6 +646,10 @@ class PhotosAbstractModel(VkontakteModel):
     def remote_id_short(self):
         return self.remote_id.split('_')[1]
 
+    @property
+    def remote_owner_id(self):
+        return int(self.remote_id.split('_')[0])
+
     @property
     def slug(self):
         return self.slug_prefix + str(self.remote_id)
@@ -211,10 +669,18 @@ class PhotosAbstractModel(VkontakteModel):
     def parse(self, response):
         # TODO: перейти на ContentType и избавиться от метода
         owner_id = int(response.pop('owner_id'))
+        context = getattr(self, '_fetch_context', None)
+        if context:
+            owner = context.get_owner(owner_id)
+        elif owner_id > 0:
+            owner = User.objects.get_or_create(remote_id=owner_id)[0]
+        else:
+            owner = Group.objects.get_or_create(remote_id=abs(owner_id))[0]
+
         if owner_id > 0:
-            self.owner = User.objects.get_or_create(remote_id=owner_id)[0]
+            self.owner = owner
         else:
-            self.group = Group.objects.get_or_create(remote_id=abs(owner_id))[0]
+            self.group = owner
 
         super(PhotosAbstractModel, self).parse(response)
 
@@ -243,7 +709,18 @@ class Album(PhotosAbstractModel):
     size = models.PositiveIntegerField(u'Кол-во фотографий')
     privacy = models.PositiveIntegerField(u'Уровень доступа к альбому', null=True, choices=ALBUM_PRIVACY_CHOCIES)
 
-    objects = models.Manager()
+    # cursor of incremental syncing of photos
+    photos_synced_created = models.DateTimeField(u'Дата последней синхронизированной фотографии', null=True)
+    photos_synced_offset = models.PositiveIntegerField(u'Смещение синхронизации фотографий', default=0)
+    photos_synced_updated = models.DateTimeField(u'Дата обновления альбома при синхронизации', null=True)
+    photos_synced_size = models.PositiveIntegerField(u'Кол-во фотографий альбома при синхронизации', null=True)
+
+    # aggregates of photos, maintained by deltas while fetching photos
+    photos_count = models.PositiveIntegerField(u'Кол-во сохраненных фотографий', default=0)
+    photos_likes_count = models.PositiveIntegerField(u'Лайков фотографий', default=0)
+    photos_comments_count = models.PositiveIntegerField(u'Комментариев фотографий', default=0)
+
+    objects = SearchManager()
     remote = AlbumRemoteManager(remote_pk=('remote_id',), methods={
         'get': 'getAlbums',
 #        'edit': 'editAlbum',
@@ -256,9 +733,68 @@ class Album(PhotosAbstractModel):
     def __str__(self):
         return self.title
 
+    def _substitute(self, old_instance):
+        super(Album, self)._substitute(old_instance)
+        # keep cursor of sync and aggregates of photos, they are not a part of API response
+        for field_name in ALBUM_LOCAL_FIELDS:
+            setattr(self, field_name, getattr(old_instance, field_name))
+
     @atomic
+    def save(self, *args, **kwargs):
+        '''
+        Save album with actual aggregates of photos. They are changed only by UPDATE with F() expressions,
+        so they are read again from the row, locked till the end of transaction, and full-row save
+        doesn't overwrite changes, made after album was read
+        '''
+        if self.pk and not kwargs.get('force_insert'):
+            for values in Album.objects.select_for_update().filter(pk=self.pk).values(*ALBUM_AGGREGATED_FIELDS):
+                for field_name, value in values.items():
+                    setattr(self, field_name, value)
+        return super(Album, self).save(*args, **kwargs)
+
     def fetch_photos(self, *args, **kwargs):
-        return Photo.remote.fetch(album=self, *args, **kwargs)
+        # concurrent fetches of the same photos are coalesced into one
+        return Photo.remote.fetch_once(album=self, *args, **kwargs)
+
+    def sync_photos(self, full=False, **kwargs):
+        '''
+        Fetch photos, added to album after the previous sync, starting from the stored offset.
+        If `full` is True, rescan the whole album. Stores cursor of sync after fetching.
+        Should be called outside of transaction, the same as fetch_photos()
+        '''
+        offset, after = self.get_photos_cursor(full)
+        photos = self.fetch_photos(offset=offset, after=after, **kwargs)
+
+        self.save_photos_cursor()
+        return photos
+
+    def get_photos_cursor(self, full=False):
+        '''
+        Return offset and date `after` for fetching photos, added after the previous sync
+        '''
+        if full or not self.photos_synced_created:
+            return 0, None
+        # step back in case of photos, deleted from album after the previous sync
+        return max(0, self.photos_synced_offset - SYNC_OFFSET_OVERLAP), self.photos_synced_created
+
+    @atomic
+    def save_photos_cursor(self, offset=None):
+        '''
+        Save cursor of sync: offset of the next page or number of stored photos, if offset is unknown
+        '''
+        self.photos_synced_offset = self.photos.count() if offset is None else offset
+        self.photos_synced_created = self.photos.aggregate(created=models.Max('created'))['created']
+        self.photos_synced_updated = self.updated
+        self.photos_synced_size = self.size
+        Album.objects.filter(pk=self.pk).update(**dict([(field_name, getattr(self, field_name))
+                                                        for field_name in ALBUM_SYNC_FIELDS]))
+
+    @property
+    def photos_changed(self):
+        '''
+        True if album was changed remotely after the last sync of photos
+        '''
+        return self.photos_synced_updated != self.updated or self.photos_synced_size != self.size
 
 
 class Photo(PhotosAbstractModel):
@@ -274,11 +810,9 @@ class Photo(PhotosAbstractModel):
 
     user = models.ForeignKey(User, verbose_name=u'Автор фотографии', null=True, related_name='photos_author')
 
-    src = models.CharField(u'Иконка', max_length='200')
-    src_big = models.CharField(u'Большая', max_length='200')
-    src_small = models.CharField(u'Маленькая', max_length='200')
-    src_xbig = models.CharField(u'Большая X', max_length='200')
-    src_xxbig = models.CharField(u'Большая XX', max_length='200')
+    # URLs of all sizes are stored as common prefix and compact list of sizes, see sizes.encode_sizes()
+    src_prefix = models.CharField(u'Адрес размеров', max_length='200')
+    src_sizes = models.TextField(u'Размеры')
 
     width = models.PositiveIntegerField(null=True)
     height = models.PositiveIntegerField(null=True)
@@ -294,9 +828,14 @@ class Photo(PhotosAbstractModel):
 
     created = models.DateTimeField(db_index=True)
 
-    objects = models.Manager()
+    # hashes of downloaded files of sizes, see download.encode_hashes()
+    local_hashes = models.TextField(u'Загруженные файлы', default='')
+    downloaded = models.DateTimeField(u'Дата загрузки файлов', null=True)
+
+    objects = SearchManager()
     remote = PhotoRemoteManager(remote_pk=('remote_id',), methods={
         'get': 'get',
+        'get_by_id': 'getById',
     })
 
     class Meta:
@@ -304,6 +843,9 @@ class Photo(PhotosAbstractModel):
         verbose_name_plural = u'Фотографии Вконтакте'
 
     def parse(self, response):
+        self.set_sizes(parse_sizes(response))
+        response.pop('sizes', None)
+
         super(Photo, self).parse(response)
 
         # counters
@@ -314,12 +856,89 @@ class Photo(PhotosAbstractModel):
         self.actions_count = self.likes_count + self.comments_count
 
         if 'user_id' in response:
-            self.user = User.objects.get_or_create(remote_id=response['user_id'])[0]
-
+            context = getattr(self, '_fetch_context', None)
+            if context:
+                self.user = context.get_owner(response['user_id'])
+            else:
+                self.user = User.objects.get_or_create(remote_id=response['user_id'])[0]
+
+        album_remote_id = self.get_remote_id(response['aid'])
+        context = getattr(self, '_fetch_context', None)
         try:
-            self.album = Album.objects.get(remote_id=self.get_remote_id(response['aid']))
+            if context:
+                album = context.get_album(album_remote_id)
+                if album is None:
+                    raise Album.DoesNotExist
+            else:
+                album = Album.objects.get(remote_id=album_remote_id)
+            self.album = album
         except Album.DoesNotExist:
-            raise Exception('Impossible to save photo for unexisted album %s' % (self.get_remote_id(response['aid']),))
+            raise Exception('Impossible to save photo for unexisted album %s' % (album_remote_id,))
+
+    def _substitute(self, old_instance):
+        super(Photo, self)._substitute(old_instance)
+        self._counters = old_instance.get_counters()
+        for field_name in PHOTO_LOCAL_FIELDS:
+            setattr(self, field_name, getattr(old_instance, field_name))
+
+    def get_counters(self):
+        return dict([(field_name, getattr(self, field_name)) for field_name in PHOTO_AGGREGATED_FIELDS])
+
+    def update_aggregates(self, old_counters):
+        '''
+        Apply changes of counters since `old_counters` to aggregates of album. Method save() adds only created
+        photos, changes of existing ones are applied by remote manager or callers, changing counters, after save()
+        '''
+        counters = self.get_counters()
+        if old_counters != counters:
+            aggregates = AlbumAggregates()
+            aggregates.change(old_counters, counters)
+            aggregates.apply()
+        self._counters = counters
+
+    def set_sizes(self, sizes):
+        self.src_prefix, self.src_sizes = encode_sizes(sizes)
+
+    @property
+    def sizes(self):
+        '''
+        List of PhotoSize ordered by width, decoded once for stored value
+        '''
+        cached = getattr(self, '_sizes_cache', None)
+        if cached is None or cached[0] != (self.src_prefix, self.src_sizes):
+            cached = self._sizes_cache = ((self.src_prefix, self.src_sizes), decode_sizes(self.src_prefix, self.src_sizes))
+        return cached[1]
+
+    def get_size(self, max_width=None, size_type=None):
+        '''
+        Return size of type `size_type` or the largest size not wider than `max_width` or the smallest one
+        '''
+        sizes = self.sizes
+        if size_type:
+            sizes = [size for size in sizes if size.type == size_type]
+        elif max_width:
+            sizes = [size for size in sizes if size.max_width <= max_width] or sizes[:1]
+        return sizes[-1] if sizes else None
+
+    def get_src(self, max_width=None, size_type=None):
+        size = self.get_size(max_width, size_type)
+        return size.src if size else ''
+
+    src = property(lambda self: self.get_src(size_type='m'))
+    src_small = property(lambda self: self.get_src(size_type='s'))
+    src_big = property(lambda self: self.get_src(size_type='x'))
+    src_xbig = property(lambda self: self.get_src(size_type='y'))
+    src_xxbig = property(lambda self: self.get_src(size_type='z'))
+
+    def get_local_path(self, size_type):
+        '''
+        Return path of downloaded file of size or None if it wasn't downloaded
+        '''
+        file_hash = decode_hashes(self.local_hashes).get(size_type)
+        return get_file_path(file_hash) if file_hash else None
+
+    def download(self, sizes=DOWNLOAD_SIZES):
+        return PhotoDownloader().download_photo(self, sizes)
 
     def fetch_comments_parser(self):
         '''
@@ -334,8 +953,11 @@ class Photo(PhotosAbstractModel):
         }
         parser = VkontaktePhotosParser().request('/al_photos.php', data=post_data)
 
-        self.comments_count = len(parser.content_bs.findAll('div', {'class': 'clear_fix pv_comment '}))
-        self.save()
+        old_counters = self.get_counters()
+        self.comments_count = parser.parse_comments_count()
+        with atomic():
+            self.save()
+            self.update_aggregates(old_counters)
 
     def fetch_likes_parser(self):
         '''
@@ -350,13 +972,23 @@ class Photo(PhotosAbstractModel):
         }
         parser = VkontaktePhotosParser().request('/like.php', data=post_data)
 
-        values = re.findall(r'value="(\d+)"', parser.html)
-        if len(values):
-            self.likes_count = int(values[0])
-            self.save()
+        likes_count = parser.parse_likes_count()
+        if likes_count is not None:
+            old_counters = self.get_counters()
+            self.likes_count = likes_count
+            with atomic():
+                self.save()
+                self.update_aggregates(old_counters)
 
     @atomic
     def fetch_likes(self, *args, **kwargs):
+        '''
+        Fetch users liked the photo. If `sync` is True, fetch only ids of users
+        and update relation `like_users` in bulk without fetching profiles of users
+        '''
+        if kwargs.pop('sync', False):
+            self.update_like_users(*Photo.remote.fetch_like_user_ids(self))
+            return self.like_users.all()
 
 #        kwargs['offset'] = int(kwargs.pop('offset', 0))
         kwargs['likes_type'] = 'photo'
@@ -370,11 +1002,33 @@ class Photo(PhotosAbstractModel):
         users = User.remote.fetch_instance_likes(self, *args, **kwargs)
 
         # update self.likes
+        old_counters = self.get_counters()
         self.likes_count = self.like_users.count()
         self.save()
+        self.update_aggregates(old_counters)
 
         return users
 
+    @atomic
+    def update_like_users(self, user_ids, count=None, context=None):
+        '''
+        Update users liked the photo by list of their remote ids, comparing them with stored rows of relation.
+        If `count` of likes is more than number of ids, list is partial and no users are removed
+        '''
+        context = context or FetchContext()
+        context.prefetch_owners(user_ids)
+        ids = set([context.get_owner(user_id).pk for user_id in user_ids])
+
+        bulk_sync_m2m(self, 'like_users', ids, remove=count is None or count <= len(ids))
+
+        old_counters = self.get_counters()
+        self.likes_count = count if count is not None else len(ids)
+        self.actions_count = self.likes_count + self.comments_count
+        Photo.objects.filter(pk=self.pk).update(likes_count=self.likes_count, actions_count=self.actions_count)
+
+        self.update_aggregates(old_counters)
+        update_leaderboards([self])
+
     @atomic
     def fetch_comments(self, *args, **kwargs):
         return Comment.remote.fetch_photo(photo=self, *args, **kwargs)
@@ -404,9 +1058,10 @@ class Comment(VkontakteModel, VkontakteCRUDModel):
     # TODO: implement with tests
 #    likes = models.PositiveIntegerField(u'Кол-во лайков', default=0)
 
-    objects = models.Manager()
+    objects = SearchManager()
     remote = CommentRemoteManager(remote_pk=('remote_id',), methods={
         'get': 'getComments',
+        'get_album': 'getAllComments',
         'create': 'createComment',
         'update': 'editComment',
         'delete': 'deleteComment',
@@ -419,7 +1074,7 @@ class Comment(VkontakteModel, VkontakteCRUDModel):
 
     @property
     def remote_owner_id(self):
-        return self.photo.remote_id.split('_')[0]
+        return self.photo.remote_owner_id
 
     @property
     def remote_id_short(self):
@@ -469,8 +1124,14 @@ class Comment(VkontakteModel, VkontakteCRUDModel):
         return Model.objects.get_or_create(remote_id=abs(remote_id))
 
     def parse(self, response):
+        context = getattr(self, '_fetch_context', None)
+        if context and context.photo and context.photo.pk == self.photo_id:
+            self.photo = context.photo
+
         # undocummented feature of API. if from_id == 101 -> comment by group
-        if response['from_id'] == 101:
+        if context and (context.photo or context.group):
+            context.set_generic_relation(self, 'author', context.get_author(response.pop('from_id')))
+        elif response['from_id'] == 101:
             self.author = self.photo.group
         else:
             self.author = self.get_or_create_group_or_user(response.pop('from_id'))[0]
@@ -488,3 +1149,184 @@ class Comment(VkontakteModel, VkontakteCRUDModel):
 
         if '_' not in str(self.remote_id):
             self.remote_id = '%s_%s' % (self.remote_owner_id, self.remote_id)
+
+
+class CrawlJobManager(models.Manager):
+
+    def unfinished(self):
+        return self.exclude(stage=CrawlJob.STAGE_DONE)
+
+
+class CrawlJob(models.Model):
+    '''
+    Long fetching of album, photo or group, which can be resumed after failure.
+    Job saves checkpoint (stage, offset and cursor) after each committed page
+    '''
+    STAGE_ALBUMS = 'albums'
+    STAGE_PHOTOS = 'photos'
+    STAGE_COMMENTS = 'comments'
+    STAGE_DONE = 'done'
+    STAGE_CHOICES = (
+        (STAGE_ALBUMS, u'Альбомы'),
+        (STAGE_PHOTOS, u'Фотографии'),
+        (STAGE_COMMENTS, u'Комментарии'),
+        (STAGE_DONE, u'Завершено'),
+    )
+    # sequence of stages for each type of target
+    STAGES = {
+        'group': [STAGE_ALBUMS, STAGE_PHOTOS],
+        'album': [STAGE_PHOTOS, STAGE_COMMENTS],
+        'photo': [STAGE_COMMENTS],
+    }
+
+    target_content_type = models.ForeignKey(ContentType, related_name='photo_crawl_jobs')
+    target_id = models.PositiveIntegerField(db_index=True)
+    target = generic.GenericForeignKey('target_content_type', 'target_id')
+
+    stage = models.CharField(u'Этап', max_length=10, choices=STAGE_CHOICES, db_index=True)
+    offset = models.PositiveIntegerField(u'Смещение', default=0)
+    cursor = models.PositiveIntegerField(u'ID последнего обработанного объекта', default=0)
+
+    error = models.TextField(u'Последняя ошибка')
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = CrawlJobManager()
+
+    class Meta:
+        verbose_name = u'Задача загрузки фотографий Вконтакте'
+        verbose_name_plural = u'Задачи загрузки фотографий Вконтакте'
+
+    @property
+    def stages(self):
+        return self.STAGES[self.target_content_type.model]
+
+    def save(self, *args, **kwargs):
+        if not self.stage:
+            self.stage = self.stages[0]
+        return super(CrawlJob, self).save(*args, **kwargs)
+
+    def checkpoint(self, **kwargs):
+        '''
+        Save progress of job without touching other fields
+        '''
+        for field_name, value in kwargs.items():
+            setattr(self, field_name, value)
+        kwargs['updated'] = timezone.now()
+        CrawlJob.objects.filter(pk=self.pk).update(**kwargs)
+
+    def run(self):
+        '''
+        Run job from the saved checkpoint till the end
+        '''
+        try:
+            while self.stage != self.STAGE_DONE:
+                getattr(self, 'run_%s' % self.stage)()
+                stages = self.stages + [self.STAGE_DONE]
+                self.checkpoint(stage=stages[stages.index(self.stage) + 1], offset=0, cursor=0)
+        except Exception as e:
+            log.error('Crawl job %s failed on stage %s, offset %d: %s' % (self.pk, self.stage, self.offset, e))
+            self.checkpoint(error=unicode(e))
+            raise
+
+    def run_albums(self):
+        Album.remote.fetch(group=self.target)
+
+    def run_photos(self):
+        if isinstance(self.target, Album):
+            albums = [self.target]
+        else:
+            albums = self.target.photoalbums.filter(pk__gt=self.cursor).order_by('pk')
+
+        for album in albums:
+            for offset, photos in Photo.remote.iter_fetch(album, offset=self.offset):
+                self.checkpoint(offset=offset)
+            self.checkpoint(cursor=album.pk, offset=0)
+
+    def run_comments(self):
+        if isinstance(self.target, Album):
+            # comments of all photos of album are fetched by pages of photos.getAllComments
+            for offset, comments in Comment.remote.iter_fetch_album(self.target, offset=self.offset):
+                self.checkpoint(offset=offset)
+            return
+
+        while True:
+            count = Comment.remote.fetch_photo(self.target, offset=self.offset, count=COMMENTS_PAGE_SIZE).count()
+            self.checkpoint(offset=self.offset + count)
+            if count < COMMENTS_PAGE_SIZE:
+                break
+
+
+class FetchLock(models.Model):
+    '''
+    Lock of fetch in progress, shared between processes. Keeps ranges of ids of fetched objects after finish
+    for processes waiting for the same fetch
+    '''
+    key = models.CharField(max_length=100, unique=True)
+    result = models.TextField(u'ID полученных объектов')
+
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True)
+
+    class Meta:
+        verbose_name = u'Блокировка загрузки Вконтакте'
+        verbose_name_plural = u'Блокировки загрузки Вконтакте'
+
+
+class PhotoLeaderboardManager(models.Manager):
+
+    def top(self, group=None, album=None, window=LEADERBOARD_WINDOWS[0], count=LEADERBOARD_SIZE):
+        '''
+        Return list of top photos of group or album by actions_count, created during last `window` days
+        '''
+        if window not in LEADERBOARD_WINDOWS:
+            raise ValueError("Leaderboards are maintained only for windows %s" % (LEADERBOARD_WINDOWS,))
+        if count > LEADERBOARD_SIZE:
+            raise ValueError("Attribute 'count' can not be more than %d" % LEADERBOARD_SIZE)
+
+        entries = self.filter(window=window, photo_created__gte=timezone.now() - timedelta(days=window))
+        if group:
+            entries = entries.filter(group=group)
+        elif album:
+            entries = entries.filter(album=album)
+        else:
+            raise ValueError("You must specify group or album")
+
+        return [entry.photo for entry in entries.select_related('photo').order_by('-actions_count')[:count]]
+
+
+class PhotoLeaderboard(models.Model):
+    '''
+    Entry of top photos of group or album by actions_count during window of days.
+    Every leaderboard keeps bounded number of entries, updated while fetching photos
+    '''
+    group = models.ForeignKey(Group, null=True, related_name='photo_leaderboard')
+    album = models.ForeignKey(Album, null=True, related_name='leaderboard')
+    window = models.PositiveSmallIntegerField(u'Период, дней')
+
+    photo = models.ForeignKey(Photo, related_name='leaderboard_entries')
+    actions_count = models.PositiveIntegerField(u'Действий')
+    photo_created = models.DateTimeField()
+
+    objects = PhotoLeaderboardManager()
+
+    class Meta:
+        verbose_name = u'Рейтинг фотографий Вконтакте'
+        verbose_name_plural = u'Рейтинги фотографий Вконтакте'
+        # the same photo can't be added to leaderboard twice by concurrent updates
+        unique_together = (('group', 'window', 'photo'), ('album', 'window', 'photo'))
+
+
+@receiver(post_save, sender=Photo)
+def add_created_photo_to_album(sender, instance, created, raw=False, **kwargs):
+    # every deleted photo is subtracted from aggregates, so every created one should be added
+    if created and not raw:
+        instance.update_aggregates(None)
+
+
+@receiver(post_delete, sender=Photo)
+def subtract_deleted_photo_from_album(sender, instance, **kwargs):
+    aggregates = AlbumAggregates()
+    aggregates.add(getattr(instance, '_counters', None) or instance.get_counters(), -1)
+    aggregates.apply()
@@ -2,9 +2,111 @@
 from datetime import datetime
 from vkontakte_api.parser import VkontakteParser, VkontakteParseError
 import re
+import threading
+
+from django.conf import settings
+import requests
+from requests.adapters import HTTPAdapter
+
+# number of kept-alive connections to vk.com, shared by parsers of all threads of process
+PARSER_POOL_SIZE = getattr(settings, 'VKONTAKTE_PHOTOS_PARSER_POOL_SIZE', 10)
+PARSER_TIMEOUT = getattr(settings, 'VKONTAKTE_PHOTOS_PARSER_TIMEOUT', 30)
+
+
+def get_adapter(pool_size=PARSER_POOL_SIZE, hosts=1):
+    '''
+    Return adapter with pools of kept-alive connections to `hosts` hosts, it's safe to share it between threads
+    '''
+    return HTTPAdapter(pool_connections=hosts, pool_maxsize=pool_size)
+
+
+def get_session(adapter, headers=None):
+    '''
+    Return session, sending gzip-compressed requests through `adapter`
+    '''
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({
+        'Accept-Language': 'ru-RU,ru;q=0.8',
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+    })
+    session.headers.update(headers or {})
+    return session
+
+
+class ThreadSessions(object):
+    '''
+    Sessions, one per thread, with one pool of connections for all of them.
+    Cookies, received by one thread, are not sent by others
+    '''
+    def __init__(self, adapter, headers=None):
+        self.adapter = adapter
+        self.headers = headers
+        self.local = threading.local()
+
+    def get(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = get_session(self.adapter, self.headers)
+        return session
+
+sessions = ThreadSessions(get_adapter())
+
+# exact value of attribute in markup of vk.com, BeautifulSoup matches classes one by one
+COMMENT_CLASS = 'clear_fix pv_comment '
+COMMENT_RE = re.compile(r'<div[^>]*\sclass="%s"' % COMMENT_CLASS)
+LIKES_RE = re.compile(r'value="(\d+)"')
+
 
 class VkontaktePhotosParser(VkontakteParser):
-    pass
+
+    def __init__(self, content='', session=None):
+        super(VkontaktePhotosParser, self).__init__(content)
+        self.session = session or sessions.get()
+
+    def request(self, *args, **kwargs):
+        '''
+        Make request through the session of thread instead of new connection for every request
+        '''
+        args = list(args)
+        if 'http' not in args[0]:
+            args[0] = 'http://vk.com' + args[0]
+        kwargs.setdefault('timeout', PARSER_TIMEOUT)
+
+        if kwargs.pop('method', None) == 'get':
+            response = self.session.get(*args, **kwargs)
+        else:
+            response = self.session.post(*args, **kwargs)
+
+        self.content = response.content.decode('windows-1251')
+        return self
+
+    def parse_comments_count(self):
+        '''
+        Count comments in response of al_photos.php by regexp without building DOM.
+        Falls back to BeautifulSoup if markup of comments differs from expected
+        '''
+        html = self.html
+        count = len(COMMENT_RE.findall(html))
+        if not count and 'pv_comment' in html:
+            count = len(self.content_bs.findAll('div', {'class': 'pv_comment'}))
+        return count
+
+    def parse_likes_count(self):
+        '''
+        Return number of likes from response of like.php or None if it's not found
+        '''
+        html = self.html
+        match = LIKES_RE.search(html)
+        if match:
+            return int(match.group(1))
+        if 'value=' in html:
+            tag = self.content_bs.find(attrs={'value': re.compile(r'^\d+$')})
+            if tag:
+                return int(tag['value'])
+        return None
 #    def parse_container_date(self, container):
 #
 #        text = container.find('span', {'class': re.compile('^rel_date')})
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+log = logging.getLogger('vkontakte_photos')
+
+# VK allows 3 requests per second for one access token
+API_RATE = getattr(settings, 'VKONTAKTE_PHOTOS_API_RATE', 3)
+# number of access tokens, used by all processes together
+API_TOKENS = getattr(settings, 'VKONTAKTE_PHOTOS_API_TOKENS', 1)
+# directory for state files of rate limiter, shared between processes. If None, limiter works inside process only
+API_RATE_LIMIT_DIR = getattr(settings, 'VKONTAKTE_PHOTOS_API_RATE_LIMIT_DIR', None)
+API_RATE_LIMIT_KEY = getattr(settings, 'VKONTAKTE_PHOTOS_API_RATE_LIMIT_KEY', 'default')
+
+
+class RateLimiter(object):
+    '''
+    Thread-safe token bucket: allows `rate` calls per second with bursts up to `burst` calls
+    '''
+    def __init__(self, rate=API_RATE, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+        # metrics
+        self.calls = 0
+        self.waited = 0.
+        self.max_wait = 0.
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        '''
+        Take one token if bucket has it. Returns delay before the next try or 0 if token was taken
+        '''
+        self.refill(time.time())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        '''
+        Block until call is allowed. Returns number of seconds spent in waiting
+        '''
+        started = time.time()
+        while True:
+            with self.lock:
+                delay = self.take()
+                if not delay:
+                    waited = time.time() - started
+                    self.calls += 1
+                    self.waited += waited
+                    self.max_wait = max(self.max_wait, waited)
+                    if waited:
+                        log.debug('API call was delayed by rate limiter for %.3f sec' % waited)
+                    return waited
+            time.sleep(delay)
+
+    @property
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'waited': self.waited,
+            'max_wait': self.max_wait,
+            'avg_wait': self.waited / self.calls if self.calls else 0.,
+        }
+
+
+class FileRateLimiter(RateLimiter):
+    '''
+    Token bucket, shared by all processes of the host through state file, locked by flock()
+    '''
+    def __init__(self, path, *args, **kwargs):
+        self.path = path
+        super(FileRateLimiter, self).__init__(*args, **kwargs)
+
+    def take(self):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    self.tokens, self.updated = [float(value) for value in f.read().split()]
+                except ValueError:
+                    # new or broken state file
+                    self.tokens, self.updated = self.burst, time.time()
+
+                delay = super(FileRateLimiter, self).take()
+
+                f.seek(0)
+                f.truncate()
+                f.write('%f %f' % (self.tokens, self.updated))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return delay
+
+
+def get_rate_limiter(rate=API_RATE * API_TOKENS, directory=API_RATE_LIMIT_DIR, key=API_RATE_LIMIT_KEY):
+    if directory:
+        return FileRateLimiter(os.path.join(directory, 'vkontakte_photos_%s.ratelimit' % key), rate=rate)
+    return RateLimiter(rate=rate)
+
+
+# shared by remote managers of all models of application
+api_rate_limiter = get_rate_limiter()
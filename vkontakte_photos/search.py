@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import logging
+import operator
+
+from django.conf import settings
+from django.db import connections, models
+
+log = logging.getLogger('vkontakte_photos')
+
+# text search configuration of PostgreSQL
+SEARCH_CONFIG = getattr(settings, 'VKONTAKTE_PHOTOS_SEARCH_CONFIG', 'russian')
+
+# indexed text columns of tables
+SEARCH_TABLES = {
+    'vkontakte_photos_album': ('title', 'description'),
+    'vkontakte_photos_photo': ('text',),
+    'vkontakte_photos_comment': ('text',),
+}
+
+# results of checks of full-text indexes by (connection alias, table)
+_installed = {}
+
+
+def get_fts_table(table):
+    return '%s_fts' % table
+
+
+def get_install_sql(vendor, table, columns, config=SEARCH_CONFIG):
+    '''
+    Return SQL statements, creating full-text index of `columns` of `table`, updated by triggers.
+    PostgreSQL: tsvector column `search_vector` with GIN index.
+    SQLite: external content FTS5 table `<table>_fts` with rowid equal to id of row
+    '''
+    if vendor == 'postgresql':
+        document = " || ' ' || ".join(["coalesce(%s, '')" % column for column in columns])
+        return [
+            'ALTER TABLE %s ADD COLUMN search_vector tsvector' % table,
+            "UPDATE %s SET search_vector = to_tsvector('%s', %s)" % (table, config, document),
+            'CREATE INDEX %s_search_vector ON %s USING gin(search_vector)' % (table, table),
+            # trigger is fired only by changes of indexed columns, not by updates of counters
+            "CREATE TRIGGER %s_search_vector BEFORE INSERT OR UPDATE OF %s ON %s FOR EACH ROW "
+            "EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.%s', %s)" % (
+                table, ', '.join(columns), table, config, ', '.join(columns)),
+        ]
+    elif vendor == 'sqlite':
+        fts = get_fts_table(table)
+        names = ', '.join(columns)
+        new_values = ', '.join(['new.%s' % column for column in columns])
+        old_values = ', '.join(['old.%s' % column for column in columns])
+        insert = 'INSERT INTO %s(rowid, %s) VALUES (new.id, %s);' % (fts, names, new_values)
+        delete = "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.id, %s);" % (fts, fts, names, old_values)
+        return [
+            "CREATE VIRTUAL TABLE %s USING fts5(%s, content='%s', content_rowid='id')" % (fts, names, table),
+            'CREATE TRIGGER %s_insert AFTER INSERT ON %s BEGIN %s END' % (fts, table, insert),
+            'CREATE TRIGGER %s_delete AFTER DELETE ON %s BEGIN %s END' % (fts, table, delete),
+            'CREATE TRIGGER %s_update AFTER UPDATE OF %s ON %s BEGIN %s %s END' % (fts, names, table, delete, insert),
+            "INSERT INTO %s(%s) VALUES ('rebuild')" % (fts, fts),
+        ]
+    return []
+
+
+def get_uninstall_sql(vendor, table):
+    if vendor == 'postgresql':
+        return [
+            'DROP TRIGGER %s_search_vector ON %s' % (table, table),
+            'ALTER TABLE %s DROP COLUMN search_vector' % table,
+        ]
+    elif vendor == 'sqlite':
+        fts = get_fts_table(table)
+        return ['DROP TRIGGER %s_%s' % (fts, name) for name in ('insert', 'delete', 'update')] + [
+            'DROP TABLE %s' % fts,
+        ]
+    return []
+
+
+def install_search(execute, vendor):
+    '''
+    Create full-text indexes of all tables, executing statements by function `execute`.
+    Returns False if backend has no supported full-text search
+    '''
+    statements = []
+    for table, columns in SEARCH_TABLES.items():
+        statements += get_install_sql(vendor, table, columns)
+    for sql in statements:
+        execute(sql)
+    _installed.clear()
+    return bool(statements)
+
+
+def uninstall_search(execute, vendor):
+    for table in SEARCH_TABLES:
+        for sql in get_uninstall_sql(vendor, table):
+            execute(sql)
+    _installed.clear()
+
+
+def is_search_installed(connection, table):
+    '''
+    Check once per connection and table, if full-text index was created by migration
+    '''
+    key = (connection.alias, table)
+    if key not in _installed:
+        cursor = connection.cursor()
+        if connection.vendor == 'postgresql':
+            columns = [column[0] for column in connection.introspection.get_table_description(cursor, table)]
+            _installed[key] = 'search_vector' in columns
+        elif connection.vendor == 'sqlite':
+            _installed[key] = get_fts_table(table) in connection.introspection.table_names()
+        else:
+            _installed[key] = False
+    return _installed[key]
+
+
+def get_match_query(query):
+    '''
+    Return FTS5 query, matching all words of `query` without interpreting its syntax
+    '''
+    return ' '.join(['"%s"' % word.replace('"', '""') for word in query.split()])
+
+
+def search(queryset, query):
+    '''
+    Filter `queryset` by full-text `query`, ordering by rank if index exists.
+    Falls back to icontains filtering of indexed columns otherwise
+    '''
+    table = queryset.model._meta.db_table
+    connection = connections[queryset.db]
+    if not query.strip():
+        return queryset.none()
+
+    if not is_search_installed(connection, table):
+        columns = SEARCH_TABLES[table]
+        return queryset.filter(reduce(operator.or_, [models.Q(**{'%s__icontains' % column: query})
+                                                     for column in columns]))
+
+    if connection.vendor == 'postgresql':
+        tsquery = 'plainto_tsquery(%s, %s)'
+        return queryset.extra(
+            select={'search_rank': 'ts_rank(%s.search_vector, %s)' % (table, tsquery)},
+            select_params=(SEARCH_CONFIG, query),
+            where=['%s.search_vector @@ %s' % (table, tsquery)],
+            params=(SEARCH_CONFIG, query),
+            order_by=('-search_rank',))
+    elif connection.vendor == 'sqlite':
+        fts = get_fts_table(table)
+        match = get_match_query(query)
+        return queryset.extra(
+            # bm25() is negative, better matches have lower values
+            select={'search_rank': 'SELECT bm25(%s) FROM %s WHERE %s MATCH %%s AND %s.rowid = %s.id' % (
+                fts, fts, fts, fts, table)},
+            select_params=(match,),
+            where=['%s.id IN (SELECT rowid FROM %s WHERE %s MATCH %%s)' % (table, fts, fts)],
+            params=(match,),
+            order_by=('search_rank',))
+
+
+class SearchManager(models.Manager):
+    '''
+    Manager with full-text search by indexed columns of model
+    '''
+    def search(self, query):
+        return search(self.all(), query)
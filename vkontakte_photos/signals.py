@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# sent once per page of objects, saved by set-based statements in bulk mode of remote managers
+vkontakte_photos_bulk_upserted = Signal(providing_args=["result"])
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+import hashlib
+import logging
+import operator
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, models
+from django.utils import timezone
+import simplejson as json
+from vkontakte_api.decorators import atomic
+
+log = logging.getLogger('vkontakte_photos')
+
+# seconds after which lock of crashed process is considered as stale
+FETCH_LOCK_TIMEOUT = getattr(settings, 'VKONTAKTE_PHOTOS_FETCH_LOCK_TIMEOUT', 3600)
+# seconds between checks of lock of another process
+FETCH_LOCK_POLL_INTERVAL = getattr(settings, 'VKONTAKTE_PHOTOS_FETCH_LOCK_POLL_INTERVAL', 1)
+# seconds to keep finished lock with result for processes, waiting for it, should be longer than poll interval
+FETCH_LOCK_RESULT_TIMEOUT = getattr(settings, 'VKONTAKTE_PHOTOS_FETCH_LOCK_RESULT_TIMEOUT', 60)
+# max number of ranges of pk, describing result of fetch for other processes. Every range takes 2 variables
+# of query, SQLite allows 999 of them. More scattered results are fetched again by other processes
+FETCH_LOCK_MAX_RANGES = getattr(settings, 'VKONTAKTE_PHOTOS_FETCH_LOCK_MAX_RANGES', 400)
+
+
+def get_flight_key(model, method, args, kwargs):
+    '''
+    Return key of call, the same for calls with equal arguments. Model instances are replaced by their pk
+    '''
+    def normalize(value):
+        if isinstance(value, models.Model):
+            return '%s:%s' % (value._meta.object_name, value.pk)
+        return unicode(value)
+
+    params = [normalize(arg) for arg in args] + sorted([(key, normalize(value)) for key, value in kwargs.items()])
+    digest = hashlib.md5(json.dumps(params).encode('utf-8')).hexdigest()
+    return '%s.%s:%s' % (model._meta.object_name, method, digest)
+
+
+def get_pk_ranges(pks):
+    '''
+    Return list of [first, last] ranges of consecutive values of `pks`
+    '''
+    ranges = []
+    for pk in sorted(pks):
+        if ranges and ranges[-1][1] == pk - 1:
+            ranges[-1][1] = pk
+        else:
+            ranges.append([pk, pk])
+    return ranges
+
+
+class Flight(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''
+    Coalescing of concurrent calls with the same key: only one of them runs function,
+    others wait for it and share its result. Calls are coalesced inside process by threading.Event
+    and between processes by row of FetchLock in DB
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, func, model):
+        '''
+        Call `func` returning queryset of `model` once for all concurrent callers with the same `key`
+        '''
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            log.debug('Waiting for in-flight call %s of the same process' % key)
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result.all()
+
+        try:
+            flight.result = self.do_locked(key, func, model)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+
+    def do_locked(self, key, func, model):
+        '''
+        Call `func` holding row of FetchLock with `key` or wait for another process holding it.
+        Lock should be taken outside of transaction to be visible for other processes
+        '''
+        from .models import FetchLock
+
+        while True:
+            try:
+                with atomic():
+                    lock = FetchLock.objects.create(key=key)
+            except IntegrityError:
+                result = self.wait(key, model)
+                if result is not None:
+                    return result
+                continue
+
+            # every key of call leaves own row, results of finished calls are not waited for by anybody already
+            FetchLock.objects.filter(finished__lt=timezone.now() - timedelta(seconds=FETCH_LOCK_RESULT_TIMEOUT)).delete()
+
+            try:
+                result = func()
+            except Exception:
+                FetchLock.objects.filter(pk=lock.pk).delete()
+                raise
+
+            # objects of one fetch are mostly saved by bulk insert and take few ranges of pk
+            ranges = get_pk_ranges(result.values_list('pk', flat=True))
+            FetchLock.objects.filter(pk=lock.pk).update(
+                finished=timezone.now(), result=json.dumps(ranges) if len(ranges) <= FETCH_LOCK_MAX_RANGES else '')
+            return result
+
+    def get_lock(self, **kwargs):
+        from .models import FetchLock
+        try:
+            return FetchLock.objects.get(**kwargs)
+        except FetchLock.DoesNotExist:
+            return None
+
+    def wait(self, key, model):
+        '''
+        Wait for call of another process. Returns queryset of its result
+        or None if lock is released without result, stale or its result is not shared and lock should be taken again
+        '''
+        from .models import FetchLock
+
+        lock = self.get_lock(key=key)
+        if lock and lock.finished:
+            # result of call finished before
+            FetchLock.objects.filter(pk=lock.pk).delete()
+            return None
+
+        log.debug('Waiting for in-flight call %s of another process' % key)
+        while lock and not lock.finished:
+            if lock.created < timezone.now() - timedelta(seconds=FETCH_LOCK_TIMEOUT):
+                # lock of crashed process
+                log.warning('Lock of call %s is stale, it is taken again' % key)
+                FetchLock.objects.filter(pk=lock.pk, finished__isnull=True).delete()
+                return None
+            time.sleep(FETCH_LOCK_POLL_INTERVAL)
+            lock = self.get_lock(pk=lock.pk)
+
+        if lock and lock.result:
+            ranges = json.loads(lock.result)
+            if not ranges:
+                return model.objects.none()
+            return model.objects.filter(reduce(operator.or_, [models.Q(pk__range=pk_range) for pk_range in ranges]))
+        return None
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+import os
+
+# types of sizes by fields of response of photos.get without photo_sizes=1
+SRC_FIELDS_TYPES = (
+    ('src_small', 's'),
+    ('src', 'm'),
+    ('src_big', 'x'),
+    ('src_xbig', 'y'),
+    ('src_xxbig', 'z'),
+    ('src_xxxbig', 'w'),
+)
+
+# maximum width of every type of size, used if response doesn't contain dimensions of size
+TYPES_WIDTHS = {
+    's': 75,
+    'm': 130,
+    'o': 130,
+    'p': 200,
+    'q': 320,
+    'r': 510,
+    'x': 604,
+    'y': 807,
+    'z': 1280,
+    'w': 2560,
+}
+
+SIZES_SEPARATOR = ';'
+SIZE_SEPARATOR = ':'
+
+
+class PhotoSize(namedtuple('PhotoSize', ['type', 'src', 'width', 'height'])):
+
+    @property
+    def max_width(self):
+        return self.width or TYPES_WIDTHS.get(self.type, 0)
+
+
+def parse_sizes(response):
+    '''
+    Return list of PhotoSize from response of photos.get with or without photo_sizes=1
+    '''
+    if response.get('sizes'):
+        return [PhotoSize(size['type'], size['src'], int(size.get('width') or 0), int(size.get('height') or 0))
+                for size in response['sizes']]
+    return [PhotoSize(size_type, response[field_name], 0, 0)
+            for field_name, size_type in SRC_FIELDS_TYPES if response.get(field_name)]
+
+
+def encode_sizes(sizes):
+    '''
+    Return common prefix of URLs of sizes and compact string with type, rest of URL and dimensions of every size:
+    's:s_c3bba2a8.jpg:75:50;m:m_7875d2fb.jpg:130:87'
+    '''
+    if not sizes:
+        return '', ''
+    prefix = os.path.commonprefix([size.src for size in sizes])
+    prefix = prefix[:prefix.rfind('/') + 1]
+    return prefix, SIZES_SEPARATOR.join([SIZE_SEPARATOR.join([size.type, size.src[len(prefix):],
+                                                              str(size.width), str(size.height)]) for size in sizes])
+
+
+def decode_sizes(prefix, value):
+    '''
+    Return list of PhotoSize, encoded by encode_sizes(), ordered by width
+    '''
+    sizes = []
+    for part in value.split(SIZES_SEPARATOR) if value else []:
+        size_type, rest = part.split(SIZE_SEPARATOR, 1)
+        src, width, height = rest.rsplit(SIZE_SEPARATOR, 2)
+        sizes += [PhotoSize(size_type, prefix + src, int(width), int(height))]
+    return sorted(sizes, key=lambda size: size.max_width)
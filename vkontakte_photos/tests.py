@@ -1,14 +1,39 @@
 # -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+import os
+from StringIO import StringIO
+import tempfile
+import threading
+import time
+
+from django.core.management import call_command
+from django.db import connection, connections, DEFAULT_DB_ALIAS
 from django.test import TestCase
 from django.utils import timezone
 import mock
+import requests
 import simplejson as json
+from vkontakte_api.decorators import atomic
 from vkontakte_groups.factories import GroupFactory
 from vkontakte_users.factories import UserFactory, User
 from vkontakte_users.tests import user_fetch_mock
 
+from .cache import ResponseCache
+from .context import FetchContext, LRUCache, create_stubs
+from .download import PhotoDownloader, decode_hashes, get_file_path
+from .execute import get_execute_code
 from .factories import AlbumFactory, PhotoFactory
-from .models import Album, Photo, Comment
+from .leaderboards import update_leaderboards
+from .models import Album, Photo, Comment, CrawlJob, FetchLock, PhotoLeaderboard
+from .parser import VkontaktePhotosParser
+from .ratelimit import RateLimiter, FileRateLimiter
+from .search import install_search, uninstall_search
+from .signals import vkontakte_photos_bulk_upserted
+from .singleflight import get_pk_ranges, single_flight
+from .sizes import PhotoSize
+from .workers import run_in_threads, submit
 
 GROUP_ID = 16297716
 ALBUM_ID = '-16297716_154228728'
@@ -20,6 +45,30 @@ ALBUM_CRUD_ID = '-59154616_180124643'
 USER_AUTHOR_ID = 201164356
 
 
+@contextmanager
+def workers_share_connection():
+    '''
+    Make pools of workers use connection of test, other connections don't see rows of test transaction.
+    Pools are limited to one thread, so the connection is used by one thread at a time
+    '''
+    test_connection = connections[DEFAULT_DB_ALIAS]
+
+    def share():
+        connections[DEFAULT_DB_ALIAS] = test_connection
+
+    test_connection.allow_thread_sharing = True
+    executor = ThreadPool(1, share)
+    try:
+        with mock.patch('vkontakte_photos.workers.ThreadPool', lambda processes: ThreadPool(1, share)), \
+                mock.patch('vkontakte_photos.workers._executor', executor), \
+                mock.patch('vkontakte_photos.workers.connection'):
+            yield
+    finally:
+        executor.close()
+        executor.join()
+        test_connection.allow_thread_sharing = False
+
+
 class VkontaktePhotosTest(TestCase):
 
     def setUp(self):
@@ -173,6 +222,41 @@ class VkontaktePhotosTest(TestCase):
         photo.fetch_comments_parser()
         self.assertGreater(photo.comments_count, 0)
 
+    def test_parser_shares_session(self):
+
+        self.assertIs(VkontaktePhotosParser().session, VkontaktePhotosParser().session)
+
+        # parsers of other threads share connections, but not cookies
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(VkontaktePhotosParser().session))
+        thread.start()
+        thread.join()
+        self.assertIsNot(sessions[0], VkontaktePhotosParser().session)
+        self.assertIs(sessions[0].get_adapter('http://vk.com'), VkontaktePhotosParser().session.get_adapter('http://vk.com'))
+
+        response = mock.Mock(content=u'<div>ok</div>'.encode('windows-1251'))
+        with mock.patch.object(VkontaktePhotosParser().session, 'post', return_value=response) as post:
+            parser = VkontaktePhotosParser().request('/al_photos.php', data={'al': 1})
+            self.assertEqual(parser.content, '<div>ok</div>')
+            self.assertEqual(post.call_args[0][0], 'http://vk.com/al_photos.php')
+            self.assertIn('timeout', post.call_args[1])
+
+    def test_parser_fast_extraction(self):
+
+        html = '<div class="clear_fix pv_comment " id="pv_comment1">a</div>' \
+               '<div id="pv_comment2" class="clear_fix pv_comment ">b</div><div class="clear_fix">c</div>'
+        self.assertEqual(VkontaktePhotosParser(html).parse_comments_count(), 2)
+        # unexpected markup is parsed by BeautifulSoup
+        html = "<div class='clear_fix pv_comment '>a</div>"
+        self.assertEqual(VkontaktePhotosParser(html).parse_comments_count(), 1)
+        html = '<div class="pv_comment clear_fix">a</div><div class="pv_comment_reply">b</div>'
+        self.assertEqual(VkontaktePhotosParser(html).parse_comments_count(), 1)
+        self.assertEqual(VkontaktePhotosParser('<div></div>').parse_comments_count(), 0)
+
+        self.assertEqual(VkontaktePhotosParser('<input type="hidden" value="125" />').parse_likes_count(), 125)
+        self.assertEqual(VkontaktePhotosParser("<input type='hidden' value='7' />").parse_likes_count(), 7)
+        self.assertEqual(VkontaktePhotosParser('<div></div>').parse_likes_count(), None)
+
     def test_parse_album(self):
 
         response = '''{"response":[{"aid":"16178407","thumb_id":"96509883","owner_id":"6492","title":"qwerty",
@@ -247,6 +331,772 @@ class VkontaktePhotosTest(TestCase):
         self.assertEqual(instance.album, album)
         self.assertEqual(instance.group, group)
 
+    def test_parse_photo_sizes(self):
+
+        album = AlbumFactory(remote_id='6492_100001227')
+        prefix = 'http://cs9231.vkontakte.ru/u06492/100001227/'
+        response = {'pid': 146771291, 'aid': 100001227, 'owner_id': 6492, 'text': '', 'created': 1298365200,
+                    'width': 1280, 'height': 960, 'sizes': [
+                        {'src': prefix + 's_c3bba2a8.jpg', 'width': 75, 'height': 56, 'type': 's'},
+                        {'src': prefix + 'm_7875d2fb.jpg', 'width': 130, 'height': 97, 'type': 'm'},
+                        {'src': prefix + 'x_cd563004.jpg', 'width': 604, 'height': 453, 'type': 'x'},
+                        {'src': prefix + 'y_62a74569.jpg', 'width': 807, 'height': 605, 'type': 'y'},
+                        {'src': prefix + 'z_793e9682.jpg', 'width': 1280, 'height': 960, 'type': 'z'},
+                    ]}
+        instance = Photo(album=album)
+        instance.parse(response)
+        instance.save()
+
+        instance = Photo.objects.get(pk=instance.pk)
+        self.assertEqual(instance.src_prefix, prefix)
+        self.assertNotIn('http', instance.src_sizes)
+        self.assertEqual(instance.src, prefix + 'm_7875d2fb.jpg')
+        self.assertEqual(instance.src_xxbig, prefix + 'z_793e9682.jpg')
+        self.assertEqual(instance.get_src(max_width=800), prefix + 'x_cd563004.jpg')
+        self.assertEqual(instance.get_size(max_width=10).type, 's')
+        self.assertEqual(instance.get_size().height, 960)
+
+        # response without photo_sizes=1
+        instance.parse({'pid': 146771291, 'aid': 100001227, 'owner_id': 6492,
+                        'src': prefix + 'm_1.jpg', 'src_big': prefix + 'x_1.jpg'})
+        self.assertEqual(instance.src_big, prefix + 'x_1.jpg')
+        self.assertEqual(instance.src_xxbig, '')
+        self.assertEqual(instance.get_src(max_width=800), prefix + 'x_1.jpg')
+
+    def test_fetch_photos_bulk(self):
+
+        response = '''{"response":[{"pid":"146771291","aid":"100001227","owner_id":"-6492",
+            "src":"http://cs9231.vkontakte.ru/u06492/100001227/m_7875d2fb.jpg",
+            "text":"test","user_id":6492,"width":10,"height":10,"created":"1298365200"},
+            {"pid":"146772677","aid":"100001227","owner_id":-6492,
+            "src":"http://cs9231.vkontakte.ru/u06492/100001227/m_fd092958.jpg",
+            "text":"test","user_id":6492,"width":10,"height":10,"created":"1260887080"}]}
+            '''
+        group = GroupFactory(remote_id=6492)
+        album = AlbumFactory(remote_id='-6492_100001227', group=group)
+
+        results = []
+
+        def receiver(sender, result, **kwargs):
+            results.append(result.counts)
+        vkontakte_photos_bulk_upserted.connect(receiver, sender=Photo)
+
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.api_call',
+                        side_effect=lambda *a, **k: json.loads(response)['response']):
+            photos = album.fetch_photos(bulk=True)
+            self.assertEqual(photos.count(), 2)
+            self.assertEqual(Photo.objects.count(), 2)
+            self.assertEqual(results[-1], {'created': 2, 'updated': 0, 'unchanged': 0})
+
+            Photo.objects.filter(remote_id='-6492_146771291').update(text='changed')
+            photos = album.fetch_photos(bulk=True)
+            self.assertEqual(photos.count(), 2)
+            self.assertEqual(Photo.objects.count(), 2)
+            self.assertEqual(results[-1], {'created': 0, 'updated': 1, 'unchanged': 1})
+            self.assertEqual(Photo.objects.get(remote_id='-6492_146771291').text, 'test')
+
+        vkontakte_photos_bulk_upserted.disconnect(receiver, sender=Photo)
+
+    def test_fetch_context_owners(self):
+
+        user = UserFactory(remote_id=6492)
+        context = FetchContext()
+        context.prefetch([{'owner_id': '6492'}, {'owner_id': -6492, 'user_id': 100}, {'owner_id': -6492}])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(context.get_owner(6492), user)
+            self.assertEqual(context.get_owner(-6492).remote_id, 6492)
+            self.assertEqual(context.get_owner(100).remote_id, 100)
+        self.assertEqual(User.objects.filter(remote_id=100).count(), 1)
+
+        # stub was inserted concurrently by another worker, transaction of fetch goes on
+        with atomic():
+            create_stubs(User, [100, 101])
+            self.assertEqual(User.objects.filter(remote_id__in=[100, 101]).count(), 2)
+
+        album = AlbumFactory(remote_id='-6492_100001227')
+        album_other = AlbumFactory(remote_id='-6492_100001228')
+        context = FetchContext(album=album)
+        context.prefetch([{'pid': 1, 'aid': 100001227, 'owner_id': -6492},
+                          {'pid': 2, 'aid': 100001228, 'owner_id': -6492}])
+        with self.assertNumQueries(0):
+            self.assertEqual(context.get_album('-6492_100001227'), album)
+            self.assertEqual(context.get_album('-6492_100001228'), album_other)
+
+        cache = LRUCache(size=2)
+        cache.set(1, 'a')
+        cache.set(2, 'b')
+        cache.get(1)
+        cache.set(3, 'c')
+        self.assertIn(1, cache)
+        self.assertNotIn(2, cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_parse_photos_with_context(self):
+
+        group = GroupFactory(remote_id=6492)
+        UserFactory(remote_id=6492)
+        album = AlbumFactory(remote_id='-6492_100001227', group=group)
+        response = [{'pid': pid, 'aid': 100001227, 'owner_id': -6492, 'user_id': 6492, 'text': '',
+                     'src': 'http://cs9231.vkontakte.ru/u06492/100001227/m_%d.jpg' % pid, 'created': 1298365200}
+                    for pid in range(1, 11)]
+
+        # one query for users and one for groups of the whole page, album is taken from context
+        with self.assertNumQueries(2):
+            photos = Photo.remote.parse_response_list(response, {'_fetch_context': FetchContext(album=album)})
+
+        self.assertEqual(len(photos), 10)
+        self.assertTrue(all([photo.album is album and photo.group == group for photo in photos]))
+
+    def test_parse_comments_authors(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, group=group)
+        photo = PhotoFactory(remote_id=PHOTO_ID, album=album, group=group)
+        user = UserFactory(remote_id=6492)
+
+        response = [
+            {'cid': 1, 'from_id': 101, 'date': 1387173931, 'message': 'by group'},
+            {'cid': 2, 'from_id': 6492, 'date': 1387173931, 'message': 'by user'},
+            {'cid': 3, 'from_id': 6493, 'date': 1387173931, 'message': 'by new user'},
+            {'cid': 4, 'from_id': 6492, 'date': 1387173931, 'message': 'by user again'},
+        ]
+        comments = Comment.remote.parse_response(
+            response, {'photo_id': photo.id, '_fetch_context': FetchContext(photo=photo)})
+
+        self.assertEqual(comments[0].author, group)
+        self.assertEqual(comments[1].author, user)
+        self.assertEqual(comments[2].author.remote_id, 6493)
+        self.assertEqual(comments[3].author, user)
+        self.assertEqual(comments[1].remote_id, '-%s_2' % GROUP_ID)
+
+        for comment in comments:
+            comment.save()
+        self.assertEqual(Comment.objects.get(remote_id='-%s_3' % GROUP_ID).author.remote_id, 6493)
+
+    def test_fetch_album_comments(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, group=group)
+        photo1 = PhotoFactory(remote_id=PHOTO_ID, album=album, group=group)
+        photo2 = PhotoFactory(remote_id='-%s_280118216' % GROUP_ID, album=album, group=group)
+
+        response = [4,
+            {'cid': 1, 'pid': 280118215, 'from_id': 101, 'date': 1387173931, 'message': 'by group'},
+            {'cid': 2, 'pid': 280118215, 'from_id': 6492, 'date': 1387173932, 'message': 'a'},
+            {'cid': 3, 'pid': 280118216, 'from_id': 6492, 'date': 1387173933, 'message': 'b'},
+            {'cid': 4, 'pid': 280118217, 'from_id': 6492, 'date': 1387173934, 'message': 'of new photo'},
+        ]
+        with mock.patch('vkontakte_photos.models.CommentRemoteManager.api_call', return_value=response) as api_call:
+            with mock.patch('vkontakte_photos.models.PhotoRemoteManager.fetch',
+                            return_value=Photo.objects.none()) as fetch_photos:
+                comments = Comment.remote.fetch_album(album, all=True)
+                self.assertEqual(api_call.call_count, 1)
+                self.assertEqual(api_call.call_args[0][0], 'get_album')
+                self.assertEqual(fetch_photos.call_args[1]['ids'], [280118217])
+
+        self.assertEqual(comments.count(), 3)
+        self.assertEqual(photo1.comments.count(), 2)
+        self.assertEqual(photo2.comments.count(), 1)
+        self.assertEqual(Comment.objects.get(remote_id='-%s_1' % GROUP_ID).author, group)
+        self.assertEqual(Comment.objects.get(remote_id='-%s_3' % GROUP_ID).photo, photo2)
+
+    def test_response_cache(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        cache = ResponseCache({'photos.getAlbums': 60}, backend='django.core.cache.backends.locmem.LocMemCache')
+        response = [{'aid': 1, 'owner_id': -GROUP_ID, 'thumb_id': 1, 'title': 'a', 'description': '',
+                     'created': 1387173931, 'updated': 1387173931, 'size': 1}]
+
+        with mock.patch('vkontakte_photos.models.response_cache', cache):
+            with mock.patch('vkontakte_api.models.VkontakteManager.api_call', return_value=response) as api_call:
+                Album.remote.fetch(group=group)
+                Album.remote.fetch(group=group)
+                self.assertEqual(api_call.call_count, 1)
+
+                # another parameters
+                Album.remote.fetch(group=group, need_covers=True)
+                self.assertEqual(api_call.call_count, 2)
+
+                Album.remote.invalidate_cache()
+                Album.remote.fetch(group=group)
+                self.assertEqual(api_call.call_count, 3)
+
+                # expired generation doesn't bring back responses of previous generations
+                version = cache.get_version('photos.getAlbums')
+                cache.cache.delete(cache.get_version_key('photos.getAlbums'))
+                self.assertGreater(cache.get_version('photos.getAlbums'), version)
+                Album.remote.fetch(group=group)
+                self.assertEqual(api_call.call_count, 4)
+
+                # not cached method
+                Photo.remote.api_call(album_id=1)
+                Photo.remote.api_call(album_id=1)
+                self.assertEqual(api_call.call_count, 6)
+
+        self.assertIs(cache.cache, cache.cache)
+        self.assertEqual(Album.objects.count(), 1)
+
+    def test_fetch_photos_coalescing(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, group=group)
+        photo = PhotoFactory(remote_id=PHOTO_ID, album=album, group=group)
+        results = []
+
+        def fetch(*args, **kwargs):
+            # the same fetch, started by another thread, while this one is in flight
+            thread = threading.Thread(target=lambda: results.append(album.fetch_photos(extended=True)))
+            thread.start()
+            time.sleep(0.2)
+            threads.append(thread)
+            return Photo.objects.filter(album=album)
+
+        threads = []
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.fetch', side_effect=fetch) as fetch_photos:
+            photos = album.fetch_photos(extended=True)
+            threads[0].join()
+            self.assertEqual(fetch_photos.call_count, 1)
+
+        self.assertEqual(list(photos), [photo])
+        self.assertEqual(list(results[0]), [photo])
+        # lock keeps result of fetch for another processes
+        lock = FetchLock.objects.get()
+        self.assertEqual(json.loads(lock.result), [[photo.pk, photo.pk]])
+        self.assertEqual(get_pk_ranges([7, 1, 3, 2, 5]), [[1, 3], [5, 5], [7, 7]])
+
+        # lock of crashed process is taken again, even if it becomes stale while waiting for it
+        FetchLock.objects.filter(pk=lock.pk).update(finished=None)
+        with mock.patch('vkontakte_photos.singleflight.FETCH_LOCK_POLL_INTERVAL', 0.01):
+            with mock.patch('vkontakte_photos.singleflight.FETCH_LOCK_TIMEOUT', 0.05):
+                self.assertIsNone(single_flight.wait(lock.key, Photo))
+        self.assertEqual(FetchLock.objects.count(), 0)
+        FetchLock.objects.create(key=lock.key, finished=timezone.now())
+
+        # finished locks of other calls are deleted after timeout
+        FetchLock.objects.create(key='old', finished=timezone.now() - timedelta(hours=1))
+        FetchLock.objects.create(key='recent', finished=timezone.now())
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.fetch', return_value=Photo.objects.none()):
+            album.fetch_photos(extended=True)
+        self.assertEqual(sorted(FetchLock.objects.exclude(key=lock.key).values_list('key', flat=True)), ['recent'])
+        FetchLock.objects.exclude(key=lock.key).delete()
+
+        # finished lock is taken again by the next fetch, failed fetch releases lock
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.fetch', side_effect=ValueError) as fetch_photos:
+            self.assertRaises(ValueError, album.fetch_photos, extended=True)
+            self.assertEqual(fetch_photos.call_count, 1)
+        self.assertEqual(FetchLock.objects.count(), 0)
+
+    def test_benchmark_queries_command(self):
+
+        stdout = StringIO()
+        call_command('photos_benchmark_queries', albums=2, photos=5, comments=10, repeat=2, stdout=stdout)
+
+        self.assertIn('Seeded 2 albums, 10 photos, 10 comments', stdout.getvalue())
+        self.assertIn('photos of album by created', stdout.getvalue())
+        # seeded objects are deleted
+        self.assertEqual(Photo.objects.count(), 0)
+        self.assertEqual(Comment.objects.count(), 0)
+
+        # timings with and without composite indexes side by side
+        stdout = StringIO()
+        call_command('photos_benchmark_queries', albums=2, photos=5, comments=10, repeat=2, without_indexes=True,
+                     stdout=stdout)
+        self.assertIn('with indexes', stdout.getvalue())
+        self.assertEqual(stdout.getvalue().count('photos of album by created'), 3)
+
+    def test_album_aggregates(self):
+
+        def get_aggregates(album):
+            album = Album.objects.get(pk=album.pk)
+            return album.photos_count, album.photos_likes_count, album.photos_comments_count
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, group=group)
+        # aware like dates of parsed responses, they are compared with dates of stored photos
+        created = timezone.now()
+        photo1 = PhotoFactory(remote_id=PHOTO_ID, album=album, group=group, created=created, likes_count=3,
+                              comments_count=1)
+        photo2 = PhotoFactory(album=album, group=group, likes_count=5)
+        self.assertEqual(get_aggregates(album), (2, 8, 1))
+
+        # photo, created by save(), is added and subtracted the same way, aggregates are never negative
+        PhotoFactory(album=album, group=group, likes_count=7, comments_count=2).delete()
+        self.assertEqual(get_aggregates(album), (2, 8, 1))
+
+        stale_album = Album.objects.get(pk=album.pk)
+        old_counters = photo1.get_counters()
+        photo1.likes_count = 10
+        photo1.save()
+        photo1.update_aggregates(old_counters)
+        self.assertEqual(get_aggregates(album), (2, 15, 1))
+
+        # full-row save of album doesn't overwrite aggregates
+        stale_album.title = 'changed'
+        stale_album.save()
+        self.assertEqual(Album.objects.get(pk=album.pk).title, 'changed')
+        self.assertEqual(get_aggregates(album), (2, 15, 1))
+
+        # fetch without bulk
+        photo = Photo(remote_id=PHOTO_ID, album=album, group=group, user=photo1.user, created=created,
+                      likes_count=12, comments_count=1)
+        Photo.remote.get_or_create_from_instance(photo)
+        self.assertEqual(get_aggregates(album), (2, 17, 1))
+
+        # bulk fetch
+        photo = Photo(remote_id=PHOTO_ID, album=album, group=group, user=photo1.user, created=created,
+                      likes_count=10, comments_count=4)
+        photo3 = Photo(remote_id='-%s_1' % GROUP_ID, album=album, group=group, created=created, likes_count=1)
+        Photo.remote.save_bulk([photo, photo3])
+        self.assertEqual(get_aggregates(album), (3, 16, 4))
+
+        photo2.update_like_users([1, 2])
+        self.assertEqual(get_aggregates(album), (3, 13, 4))
+
+        Photo.objects.get(pk=photo3.pk).delete()
+        self.assertEqual(get_aggregates(album), (2, 12, 4))
+
+        # repair
+        Album.objects.filter(pk=album.pk).update(photos_count=0, photos_likes_count=0)
+        stdout = StringIO()
+        call_command('photos_repair_album_aggregates', group=GROUP_ID, stdout=stdout)
+        self.assertIn('Repaired aggregates of 1 albums', stdout.getvalue())
+        self.assertEqual(get_aggregates(album), (2, 12, 4))
+
+    @mock.patch('vkontakte_photos.leaderboards.LEADERBOARD_CAPACITY', 2)
+    def test_photo_leaderboards(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, group=group)
+        photo1 = PhotoFactory(album=album, group=group, actions_count=10)
+        photo2 = PhotoFactory(album=album, group=group, actions_count=20)
+        photo3 = PhotoFactory(album=album, group=group, actions_count=30)
+        photo4 = PhotoFactory(album=album, group=group, actions_count=100,
+                              created=timezone.now() - timedelta(days=10))
+        # save() doesn't touch leaderboards, they are updated by batches of fetched photos
+        self.assertEqual(PhotoLeaderboard.objects.count(), 0)
+        update_leaderboards([photo1, photo2, photo3, photo4])
+
+        self.assertEqual(PhotoLeaderboard.objects.top(group=group), [photo3, photo2])
+        self.assertEqual(PhotoLeaderboard.objects.top(album=album, window=30), [photo4, photo3])
+
+        # photo gets to the top after update of counters
+        photo1.update_like_users([1, 2, 3], count=50)
+        self.assertEqual(PhotoLeaderboard.objects.top(group=group), [photo1, photo3])
+        self.assertEqual(PhotoLeaderboard.objects.top(group=group, count=1), [photo1])
+        self.assertEqual(PhotoLeaderboard.objects.filter(group=group, window=7).count(), 2)
+
+        self.assertRaises(ValueError, PhotoLeaderboard.objects.top, group=group, window=1)
+
+        PhotoLeaderboard.objects.all().delete()
+        stdout = StringIO()
+        call_command('photos_rebuild_leaderboards', group=GROUP_ID, stdout=stdout)
+        self.assertIn('Rebuilt 4 leaderboards', stdout.getvalue())
+        self.assertEqual(PhotoLeaderboard.objects.top(group=group, window=30), [photo4, photo1])
+
+        # the same photo is added by another process after leaderboard was read
+        PhotoLeaderboard.objects.all().delete()
+        bulk_create = PhotoLeaderboard.objects.bulk_create
+
+        def concurrent_bulk_create(entries):
+            if not PhotoLeaderboard.objects.exists():
+                PhotoLeaderboard.objects.create(group=group, window=7, photo=photo1, actions_count=1,
+                                                photo_created=photo1.created)
+            return bulk_create(entries)
+
+        with mock.patch.object(PhotoLeaderboard.objects, 'bulk_create', side_effect=concurrent_bulk_create):
+            update_leaderboards([photo1, photo2])
+        self.assertEqual(PhotoLeaderboard.objects.top(group=group), [photo1, photo2])
+        self.assertEqual(PhotoLeaderboard.objects.get(group=group, window=7, photo=photo1).actions_count, 50)
+
+    def test_search(self):
+
+        cursor = connection.cursor()
+        install_search(cursor.execute, connection.vendor)
+        try:
+            group = GroupFactory(remote_id=GROUP_ID)
+            album = AlbumFactory(remote_id=ALBUM_ID, group=group, title=u'Котики', description=u'рыжая кошка')
+            photo1 = PhotoFactory(album=album, group=group, text=u'рыжая кошка на окне')
+            photo2 = PhotoFactory(album=album, group=group, text=u'кошка и кошка')
+            PhotoFactory(album=album, group=group, text=u'собака')
+            comment = Comment.objects.create(remote_id='1_1', photo=photo1, author=group, date=timezone.now(),
+                                             text=u'какая кошка')
+
+            self.assertEqual(list(Photo.objects.search(u'кошка')), [photo2, photo1])
+            self.assertEqual(list(Photo.objects.search(u'рыжая кошка')), [photo1])
+            self.assertEqual(list(Photo.objects.search(u'"рыжая')), [photo1])
+            self.assertEqual(list(Comment.objects.search(u'кошка')), [comment])
+            self.assertEqual(list(Album.objects.search(u'рыжая')), [album])
+            self.assertEqual(Photo.objects.search(u' ').count(), 0)
+
+            # index is updated by changes of text
+            photo1.text = u'собака'
+            photo1.save()
+            self.assertEqual(list(Photo.objects.search(u'кошка')), [photo2])
+            self.assertEqual(Photo.objects.search(u'собака').count(), 2)
+            photo2.delete()
+            self.assertEqual(Photo.objects.search(u'кошка').count(), 0)
+        finally:
+            uninstall_search(cursor.execute, connection.vendor)
+
+    def test_download_photos(self):
+
+        prefix = 'http://cs9231.vkontakte.ru/u06492/100001227/'
+        contents = {
+            prefix + 'x_1.jpg': 'repost',
+            prefix + 'x_2.jpg': 'repost',
+            prefix + 'z_2.jpg': 'big photo',
+        }
+
+        def get(url, headers, **kwargs):
+            content = contents[url]
+            offset = int(headers['Range'][6:-1]) if 'Range' in headers else 0
+            return mock.Mock(status_code=206 if offset else 200, iter_content=lambda size: [content[offset:]])
+
+        session = mock.Mock(get=mock.Mock(side_effect=get))
+        root = tempfile.mkdtemp()
+        downloader = PhotoDownloader(root=root, workers=2, session=session)
+
+        album = AlbumFactory(remote_id='6492_100001227')
+        photo1 = PhotoFactory(album=album)
+        photo1.set_sizes([PhotoSize('m', prefix + 'm_1.jpg', 130, 97), PhotoSize('x', prefix + 'x_1.jpg', 604, 453)])
+        photo1.save()
+        photo2 = PhotoFactory(album=album)
+        photo2.set_sizes([PhotoSize('x', prefix + 'x_2.jpg', 604, 453), PhotoSize('z', prefix + 'z_2.jpg', 1280, 960)])
+        photo2.save()
+
+        # beginning of file, downloaded before interruption
+        partial_path = downloader.get_partial_path(prefix + 'z_2.jpg')
+        os.makedirs(os.path.dirname(partial_path))
+        with open(partial_path, 'wb') as f:
+            f.write('big ')
+
+        # threads of pool don't see rows of test transaction
+        with mock.patch('vkontakte_photos.download.run_in_threads',
+                        side_effect=lambda func, items, workers: map(func, items)) as run_in_threads:
+            downloader.download_photos(Photo.objects.filter(album=album), sizes=['x', 'y', 'z'])
+            self.assertEqual(run_in_threads.call_args[0][2], 2)
+        self.assertEqual(session.get.call_count, 3)
+        self.assertEqual(session.get.call_args_list[-1][1]['headers'], {'Range': 'bytes=4-'})
+
+        photo1, photo2 = Photo.objects.filter(pk__in=[photo1.pk, photo2.pk]).order_by('pk')
+        self.assertIsNotNone(photo1.downloaded)
+        self.assertIsNone(photo1.get_local_path('z'))
+        # identical files of different photos are stored once
+        self.assertEqual(decode_hashes(photo1.local_hashes)['x'], decode_hashes(photo2.local_hashes)['x'])
+        path = get_file_path(decode_hashes(photo2.local_hashes)['z'], root)
+        self.assertEqual(open(path).read(), 'big photo')
+        self.assertFalse(os.path.exists(partial_path))
+
+        # downloaded files are not requested again
+        downloader.download_photo(photo2)
+        self.assertEqual(session.get.call_count, 3)
+
+        # files are not lost after fetching of photo
+        instance = Photo(remote_id=photo1.remote_id)
+        instance._substitute(photo1)
+        self.assertEqual(instance.local_hashes, photo1.local_hashes)
+
+        # missing file of one photo doesn't stop downloads of others
+        photo3 = PhotoFactory(album=album)
+        photo3.set_sizes([PhotoSize('x', prefix + 'x_3.jpg', 604, 453)])
+        photo3.save()
+        contents[prefix + 'z_1.jpg'] = 'big photo 1'
+        photo1.set_sizes(photo1.sizes + [PhotoSize('z', prefix + 'z_1.jpg', 1280, 960)])
+        photo1.save()
+
+        def get_or_404(url, headers, **kwargs):
+            if url not in contents:
+                return mock.Mock(status_code=404, raise_for_status=mock.Mock(side_effect=requests.HTTPError('404')))
+            return get(url, headers, **kwargs)
+
+        session.get.side_effect = get_or_404
+        with mock.patch('vkontakte_photos.download.run_in_threads',
+                        side_effect=lambda func, items, workers: map(func, items)):
+            failed = downloader.download_photos(Photo.objects.filter(pk__in=[photo1.pk, photo3.pk]).order_by('pk'))
+        self.assertEqual(failed, [photo3])
+        self.assertIsNone(Photo.objects.get(pk=photo3.pk).downloaded)
+        path = get_file_path(decode_hashes(Photo.objects.get(pk=photo1.pk).local_hashes)['z'], root)
+        self.assertEqual(open(path).read(), 'big photo 1')
+
+    def test_rate_limiter(self):
+
+        limiter = RateLimiter(rate=10, burst=2)
+        self.assertLess(limiter.acquire(), 0.05)
+        self.assertLess(limiter.acquire(), 0.05)
+        self.assertGreater(limiter.acquire(), 0.05)
+        self.assertEqual(limiter.stats['calls'], 3)
+
+        # limiters of different processes share state file
+        path = tempfile.mktemp()
+        limiter1 = FileRateLimiter(path, rate=10, burst=2)
+        limiter2 = FileRateLimiter(path, rate=10, burst=2)
+        self.assertLess(limiter1.acquire(), 0.05)
+        self.assertLess(limiter2.acquire(), 0.05)
+        self.assertGreater(limiter1.acquire(), 0.05)
+        self.assertGreater(limiter1.stats['max_wait'], 0.05)
+        os.remove(path)
+
+    def test_fetch_albums_in_threads(self):
+
+        group = GroupFactory(remote_id=6492)
+        albums = [AlbumFactory(remote_id='-6492_%d' % aid, group=group) for aid in [1, 2, 3]]
+
+        def api_call(method='get', **kwargs):
+            if kwargs['album_id'] == '3':
+                raise ValueError('Access denied')
+            return [{'pid': int(kwargs['album_id']) * 10 + i, 'aid': kwargs['album_id'], 'owner_id': -6492,
+                     'src': 'http://cs9231.vkontakte.ru/u06492/m_%d.jpg' % i, 'text': '', 'created': 1298365200}
+                    for i in range(2)]
+
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.api_call', side_effect=api_call), \
+                workers_share_connection():
+            photos = Photo.remote.fetch_albums(albums[:2], workers=2)
+            self.assertEqual(photos.count(), 4)
+            self.assertEqual(albums[0].photos.count(), 2)
+            self.assertEqual(albums[1].photos.count(), 2)
+
+            # error of one album is raised after all albums are processed
+            Photo.objects.all().delete()
+            self.assertRaises(ValueError, Photo.remote.fetch_albums, reversed(albums), workers=2)
+            self.assertEqual(Photo.objects.count(), 4)
+            self.assertEqual(albums[2].photos.count(), 0)
+
+    def test_run_in_threads(self):
+
+        processed = []
+
+        def func(item):
+            processed.append(item)
+            if item == 1:
+                raise ValueError(item)
+            return item * 2
+
+        self.assertEqual(run_in_threads(lambda item: item * 2, range(5), 3), [0, 2, 4, 6, 8])
+        self.assertRaises(ValueError, run_in_threads, func, range(5), 3)
+        self.assertItemsEqual(processed, range(5))
+        self.assertEqual(run_in_threads(func, [], 3), [])
+
+        # connection of every thread is closed once after all its items
+        with mock.patch('vkontakte_photos.workers.connection') as thread_connection:
+            self.assertEqual(run_in_threads(lambda item: item * 2, range(10), 3), range(0, 20, 2))
+            self.assertEqual(thread_connection.close.call_count, 3)
+
+    def test_submit_to_executor(self):
+
+        results = [submit(lambda x: x * 2, i) for i in range(5)]
+        self.assertEqual([result.get(timeout=5) for result in results], [0, 2, 4, 6, 8])
+
+        group = GroupFactory(remote_id=6492)
+        album = AlbumFactory(remote_id='-6492_100001227', group=group)
+        photos_response = [{'pid': pid, 'aid': 100001227, 'owner_id': -6492, 'text': '', 'created': 1298365200,
+                            'src': 'http://cs9231.vkontakte.ru/u06492/100001227/m_%d.jpg' % pid} for pid in [1, 2]]
+        comments_response = [2, {'cid': 1, 'from_id': 6492, 'date': 1387173931, 'message': 'a'},
+                             {'cid': 2, 'from_id': 101, 'date': 1387173932, 'message': 'b'}]
+
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.api_call', return_value=photos_response), \
+                mock.patch('vkontakte_photos.models.CommentRemoteManager.api_call', return_value=comments_response), \
+                workers_share_connection():
+            result = Photo.remote.afetch(album=album)
+            photos = result.get(timeout=5)
+            self.assertEqual(photos.count(), 2)
+            self.assertEqual(album.photos.count(), 2)
+
+            photo = album.photos.get(remote_id='-6492_1')
+            result = Comment.remote.afetch_photo(photo=photo)
+            comments = result.get(timeout=5)
+            self.assertEqual(comments.count(), 2)
+            self.assertEqual(photo.comments.count(), 2)
+            self.assertEqual(photo.comments.get(remote_id='-6492_2').author, group)
+
+    def test_fetch_comments_and_likes_by_execute(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, group=group)
+        photo1 = PhotoFactory(remote_id=PHOTO_ID, album=album, group=group)
+        photo2 = PhotoFactory(remote_id='-%s_280118216' % GROUP_ID, album=album, group=group)
+
+        self.assertEqual(get_execute_code([('likes.getList', {'item_id': 1}), ('likes.getList', {'item_id': 2})]),
+                         'return [API.likes.getList({"item_id": 1}),API.likes.getList({"item_id": 2})];')
+
+        response = [
+            [2, {'cid': 1, 'from_id': 6492, 'date': 1387173931, 'message': 'a'},
+             {'cid': 2, 'from_id': -6492, 'date': 1387173932, 'message': 'b'}],
+            False,
+        ]
+        with mock.patch('vkontakte_photos.execute.api_call', return_value=response) as api_call:
+            comments = Comment.remote.fetch_photos([photo1, photo2])
+            self.assertEqual(api_call.call_count, 1)
+        self.assertEqual(comments.count(), 2)
+        self.assertEqual(photo1.comments.count(), 2)
+        self.assertEqual(photo2.comments.count(), 0)
+
+        response = [{'count': 2, 'users': [1, 2]}, {'count': 1, 'users': [3]}]
+        with mock.patch('vkontakte_photos.execute.api_call', return_value=response):
+            Photo.remote.fetch_likes_photos([photo1, photo2])
+        self.assertEqual(Photo.objects.get(pk=photo1.pk).likes_count, 2)
+        self.assertItemsEqual(photo1.like_users.values_list('remote_id', flat=True), [1, 2])
+        self.assertItemsEqual(photo2.like_users.values_list('remote_id', flat=True), [3])
+
+    def test_sync_photo_like_users(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, group=group)
+        photo = PhotoFactory(remote_id=PHOTO_ID, album=album, group=group, comments_count=1)
+        photo.like_users.add(*[UserFactory(remote_id=remote_id) for remote_id in [1, 2, 3]])
+
+        responses = [{'count': 4, 'users': [2, 3]}, {'count': 4, 'users': [4, 5]}]
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.api_call', side_effect=responses) as api_call:
+            users = photo.fetch_likes(sync=True)
+            self.assertEqual(api_call.call_count, 2)
+            self.assertEqual(api_call.call_args[1]['offset'], 2)
+
+        self.assertItemsEqual(users.values_list('remote_id', flat=True), [2, 3, 4, 5])
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(photo.likes_count, 4)
+        self.assertEqual(photo.actions_count, 5)
+
+        # partial list of likes doesn't remove users
+        photo.update_like_users([6], count=10)
+        self.assertItemsEqual(photo.like_users.values_list('remote_id', flat=True), [2, 3, 4, 5, 6])
+        self.assertEqual(Photo.objects.get(pk=photo.pk).likes_count, 10)
+
+    def test_refresh_photos_counters(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, group=group)
+        photo1 = PhotoFactory(remote_id=PHOTO_ID, album=album, group=group, likes_count=1)
+        photo2 = PhotoFactory(remote_id='-%s_280118216' % GROUP_ID, album=album, group=group, likes_count=5, actions_count=5)
+
+        response = [
+            {'pid': 280118215, 'owner_id': -GROUP_ID, 'likes': {'count': 10}, 'comments': {'count': 2}, 'tags': {'count': 0}},
+            {'pid': 280118216, 'owner_id': -GROUP_ID, 'likes': {'count': 5}, 'comments': {'count': 0}, 'tags': {'count': 0}},
+        ]
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.api_call', return_value=response) as api_call:
+            updated = Photo.remote.refresh_counters(Photo.objects.all())
+            self.assertEqual(api_call.call_count, 1)
+            self.assertEqual(api_call.call_args[1]['extended'], 1)
+
+        self.assertEqual(updated, 1)
+        photo1 = Photo.objects.get(pk=photo1.pk)
+        self.assertEqual((photo1.likes_count, photo1.comments_count, photo1.actions_count), (10, 2, 12))
+        self.assertEqual(Photo.objects.get(pk=photo2.pk).likes_count, 5)
+
+        # photos are read from DB by batches of PHOTOS_BY_ID_LIMIT
+        response = [
+            {'pid': 280118215, 'owner_id': -GROUP_ID, 'likes': {'count': 20}, 'comments': {'count': 0}},
+            {'pid': 280118216, 'owner_id': -GROUP_ID, 'likes': {'count': 20}, 'comments': {'count': 0}},
+        ]
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.api_call', return_value=response) as api_call:
+            with mock.patch('vkontakte_photos.models.PHOTOS_BY_ID_LIMIT', 1):
+                self.assertEqual(Photo.remote.refresh_counters(Photo.objects.all()), 2)
+            self.assertEqual(api_call.call_count, 2)
+        self.assertEqual(list(Photo.objects.values_list('actions_count', flat=True)), [20, 20])
+
+    def test_sync_photos(self):
+
+        response = [{"pid": "146771291", "aid": "100001227", "owner_id": -6492, "text": "test", "created": "1298365200"},
+                    {"pid": "146772677", "aid": "100001227", "owner_id": -6492, "text": "test", "created": "1260887080"}]
+        group = GroupFactory(remote_id=6492)
+        album = AlbumFactory(remote_id='-6492_100001227', group=group)
+
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.api_call', return_value=response) as api_call:
+            album.sync_photos()
+            self.assertEqual(api_call.call_args[1]['offset'], 0)
+            album = Album.objects.get(pk=album.pk)
+            self.assertEqual(album.photos_synced_offset, 2)
+            self.assertEqual(album.photos_synced_created, Photo.objects.get(remote_id='-6492_146771291').created)
+
+            api_call.return_value = response[:1]
+            album.sync_photos()
+            self.assertEqual(api_call.call_args[1]['offset'], 0)
+            album.photos_synced_offset = 100
+            album.sync_photos()
+            self.assertEqual(api_call.call_args[1]['offset'], 50)
+
+            album.sync_photos(full=True)
+            self.assertEqual(api_call.call_args[1]['offset'], 0)
+
+    @mock.patch('vkontakte_photos.models.Album.sync_photos')
+    def test_sync_group_photos_skips_unchanged_albums(self, sync_photos):
+
+        response = [{"aid": "16178407", "thumb_id": "96509883", "owner_id": "-6492", "title": "qwerty",
+                     "description": "desc", "created": "1298365200", "updated": "1298365201", "size": "3"},
+                    {"aid": "17071606", "thumb_id": "98054577", "owner_id": "-6492", "title": "", "description": "",
+                     "created": "1204576880", "updated": "1229532461", "size": "3"}]
+        group = GroupFactory(remote_id=6492)
+
+        with mock.patch('vkontakte_photos.models.AlbumRemoteManager.api_call', return_value=response):
+            self.assertEqual(Album.remote.sync_photos(group=group), {'synced': 2, 'skipped': 0})
+
+            album = Album.objects.get(remote_id='-6492_16178407')
+            album.save_photos_cursor()
+            self.assertEqual(Album.remote.sync_photos(group=group), {'synced': 1, 'skipped': 1})
+            self.assertEqual(Album.objects.get(pk=album.pk).photos_synced_size, 3)
+
+            response[0]['size'] = '4'
+            self.assertEqual(Album.remote.sync_photos(group=group), {'synced': 2, 'skipped': 0})
+
+    def test_iter_fetch_photos(self):
+
+        response = [{"pid": "14677129%d" % i, "aid": "100001227", "owner_id": -6492, "text": "test",
+                     "created": "12983652%02d" % i} for i in range(5)]
+        group = GroupFactory(remote_id=6492)
+        album = AlbumFactory(remote_id='-6492_100001227', group=group)
+
+        def api_call(*args, **kwargs):
+            photos = response[::-1] if kwargs['rev'] else response
+            return photos[kwargs['offset']:kwargs['offset'] + kwargs['limit']]
+
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.api_call', side_effect=api_call):
+            pages = [(offset, len(photos)) for offset, photos in Photo.remote.iter_fetch(album, count=2)]
+            self.assertEqual(pages, [(2, 2), (4, 2), (5, 1)])
+            self.assertEqual(Photo.objects.count(), 5)
+
+            pages = [(offset, len(photos)) for offset, photos in Photo.remote.iter_sync(album, count=2)]
+            self.assertEqual(pages, [(2, 2), (4, 2), (5, 1)])
+            self.assertEqual(Album.objects.get(pk=album.pk).photos_synced_offset, 5)
+
+            # offset follows items of response, even if some of them are filtered out
+            after = Photo.objects.get(remote_id='-6492_146771292').created
+            pages = [(offset, len(photos)) for offset, photos in Photo.remote.iter_fetch(album, count=2, after=after)]
+            self.assertEqual(pages, [(2, 0), (4, 2), (5, 1)])
+
+            # photos in antichronological order are fetched till `after`
+            pages = [(offset, len(photos))
+                     for offset, photos in Photo.remote.iter_fetch(album, count=2, after=after, rev=1)]
+            self.assertEqual(pages, [(2, 2), (4, 1)])
+
+    def test_crawl_job_resume(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, group=group)
+        photo = PhotoFactory(remote_id=PHOTO_ID, album=album, group=group)
+        job = CrawlJob.objects.create(target=photo)
+        self.assertEqual(job.stage, CrawlJob.STAGE_COMMENTS)
+
+        def page(count):
+            return mock.Mock(count=mock.Mock(return_value=count))
+
+        with mock.patch('vkontakte_photos.models.CommentRemoteManager.fetch_photo',
+                        side_effect=[page(100), Exception('Too many requests per second')]):
+            self.assertRaises(Exception, job.run)
+
+        job = CrawlJob.objects.get(pk=job.pk)
+        self.assertEqual(job.stage, CrawlJob.STAGE_COMMENTS)
+        self.assertEqual(job.offset, 100)
+        self.assertIn('Too many requests', job.error)
+        self.assertEqual(CrawlJob.objects.unfinished().count(), 1)
+
+        with mock.patch('vkontakte_photos.models.CommentRemoteManager.fetch_photo',
+                        side_effect=[page(100), page(20)]) as fetch_photo:
+            job.run()
+            self.assertEqual(fetch_photo.call_args_list[0][1]['offset'], 100)
+            self.assertEqual(fetch_photo.call_args_list[1][1]['offset'], 200)
+
+        self.assertEqual(CrawlJob.objects.get(pk=job.pk).stage, CrawlJob.STAGE_DONE)
+        self.assertEqual(CrawlJob.objects.unfinished().count(), 0)
+
     def test_parse_comment(self):
 
         response = '''{"response":[21, {"date": 1387173931, "message": "[id94721323|\u0410\u043b\u0435\u043d\u0447\u0438\u043a], \u043d\u0435 1 \u0430 3 \u0431\u0430\u043d\u043a\u0430 5 \u043b\u0438\u0442\u0440\u043e\u0432 =20 \u0431\u0430\u043b\u043b\u043e\u0432", "from_id": 232760293, "likes": {"count": 1, "can_like": 1, "user_likes": 0}, "cid": 91121},
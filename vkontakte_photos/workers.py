@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+log = logging.getLogger('vkontakte_photos')
+
+EXECUTOR_SIZE = getattr(settings, 'VKONTAKTE_PHOTOS_EXECUTOR_SIZE', 10)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    '''
+    Return pool of threads, shared by all non-blocking fetch methods of the process
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPool(EXECUTOR_SIZE)
+    return _executor
+
+
+def submit(func, *args, **kwargs):
+    '''
+    Call `func` in the shared pool and return multiprocessing AsyncResult immediately.
+    Number of calls running at the same time and DB connections are bounded by size of the pool
+    '''
+    def call():
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connection.close()
+
+    return get_executor().apply_async(call)
+
+
+def run_in_threads(func, items, workers):
+    '''
+    Call `func` for every item in a pool of `workers` threads and return list of results in order of items.
+    Every thread takes the next item, until all are taken, and works with own DB connection,
+    which is closed once after that. All items are processed even if some calls fail,
+    the first error is raised after that
+    '''
+    items = list(items)
+    results = [(None, None)] * len(items)
+    indexes = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def call(item):
+        try:
+            return func(item), None
+        except Exception as e:
+            log.error("Error while processing %s in thread pool: %s" % (item, e))
+            return None, e
+
+    def work(worker):
+        try:
+            while True:
+                with lock:
+                    index = next(indexes, None)
+                if index is None:
+                    break
+                results[index] = call(items[index])
+        finally:
+            connection.close()
+
+    workers = max(1, min(int(workers), len(items)))
+    pool = ThreadPool(workers)
+    try:
+        pool.map(work, range(workers))
+    finally:
+        pool.close()
+        pool.join()
+
+    for result, error in results:
+        if error is not None:
+            raise error
+
+    return [result for result, error in results]